@@ -0,0 +1,374 @@
+"""
+    Benchmarks of fast_curate on synthetic sorting analyzers
+
+Generates analyzers of increasing size with spikeinterface's generators, then times the
+autocorrelograms, wrangling the data, getting and plotting each unit, and saving the
+labels. The analyzers are generated once and kept in `--analyzer_folder`. The results
+are saved as json, so that they can be compared across commits:
+
+    python benchmarks/run_benchmarks.py --output_path benchmarks/results/my_branch.json
+
+By default, each of the number of units, spikes per unit, number of channels and
+sparsity radius is scaled in turn, from a baseline analyzer. Pass `--quick` to only
+run the baseline, with fewer units.
+
+The time to import the GUI, and to start it up as far as checking its arguments, is
+also measured in fresh processes, and checked against `IMPORT_BUDGETS_MS`. If either is
+over budget, the benchmarks exit with an error once they've finished. Pass
+`--imports_only` to only check the import times.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import subprocess
+import tempfile
+from pathlib import Path
+from argparse import ArgumentParser
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np
+
+FAST_CURATE_FOLDER = Path(__file__).resolve().parent.parent / "fast_curate"
+sys.path.insert(0, str(FAST_CURATE_FOLDER))
+
+import spikeinterface
+from spikeinterface.core import generate_ground_truth_recording, create_sorting_analyzer, load_sorting_analyzer
+from compute import compute_autocorrelograms, compute_all_autocorrelograms, compute_cross_correlograms, get_neighbour_units
+from profiling import Profiler
+
+EXTENSIONS = ['correlograms', 'unit_locations', 'templates', 'spike_amplitudes',
+              'spike_locations', 'quality_metrics', 'template_metrics']
+
+BASELINE = {
+    'num_units': 100,
+    'spikes_per_unit': 2000,
+    'num_channels': 64,
+    'radius_um': 50,
+}
+
+SCALES = {
+    'num_units': [100, 500, 2000],
+    'spikes_per_unit': [2000, 10000, 50000],
+    'num_channels': [64, 384],
+    'radius_um': [50, 100, 200],
+}
+
+QUICK_BASELINE = {
+    'num_units': 20,
+    'spikes_per_unit': 1000,
+    'num_channels': 32,
+    'radius_um': 50,
+}
+
+# The median time, in ms, that importing `gui` and running `gui.py --help` may take. The
+# heavy imports (pandas, pyqtgraph, numba and spikeinterface) should only happen after
+# the arguments have been checked, so neither should need them.
+IMPORT_BUDGETS_MS = {
+    'import/gui': 500,
+    'import/gui_help': 1000,
+}
+
+
+def main():
+
+    parser = ArgumentParser('Benchmark fast_curate on synthetic sorting analyzers')
+    parser.add_argument(
+        '--output_path',
+        type=Path,
+        default=None,
+        help="Where to save the json results. Defaults to `benchmarks/results/<git commit>.json`"
+    )
+    parser.add_argument(
+        '--analyzer_folder',
+        type=Path,
+        default=Path(__file__).resolve().parent / "analyzers",
+        help="Folder to keep the generated analyzers in, so that they are only generated once"
+    )
+    parser.add_argument(
+        '--quick',
+        action='store_true',
+        help="Only benchmark a small baseline analyzer"
+    )
+    parser.add_argument(
+        '--repeats',
+        type=int,
+        default=3,
+        help="Number of times to construct `DataForGUI`"
+    )
+    parser.add_argument(
+        '--duration',
+        type=float,
+        default=600.,
+        help="Duration, in seconds, of the synthetic recordings"
+    )
+    parser.add_argument(
+        '--n_jobs',
+        type=int,
+        default=1,
+        help="Number of jobs used to compute the analyzers' extensions"
+    )
+    parser.add_argument(
+        '--imports_only',
+        action='store_true',
+        help="Only check the import times against their budgets"
+    )
+
+    args = parser.parse_args()
+
+    if args.quick:
+        scales = [QUICK_BASELINE]
+    else:
+        scales = get_scales(BASELINE, SCALES)
+
+    commit = get_git_commit()
+    output_path = args.output_path
+    if output_path is None:
+        output_path = Path(__file__).resolve().parent / "results" / Path(f"{commit}.json")
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    results = {
+        'info': {
+            'commit': commit,
+            'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'spikeinterface': spikeinterface.__version__,
+            'duration': args.duration,
+        },
+        'benchmarks': [],
+    }
+
+    print("Benchmarking imports")
+    results['imports'] = benchmark_imports(args.repeats)
+    with open(output_path, 'w') as output_file:
+        json.dump(results, output_file, indent=4)
+
+    if args.imports_only:
+        scales = []
+
+    for scale in scales:
+        print(f"\nBenchmarking {scale}")
+        sorting_analyzer = get_analyzer(args.analyzer_folder, scale, args.duration, args.n_jobs)
+        profiler = run_benchmarks(sorting_analyzer, args.repeats)
+        results['benchmarks'].append({'scale': scale, 'stages': profiler.report()['stages']})
+
+        # save as we go, so that a slow or failed scale doesn't lose the others
+        with open(output_path, 'w') as output_file:
+            json.dump(results, output_file, indent=4)
+
+    print(f"\nSaved results to {output_path}")
+
+    over_budget = [stage for stage, row in results['imports'].items() if row['within_budget'] is False]
+    for stage in over_budget:
+        print(f"{stage} took {results['imports'][stage]['p50_ms']:.0f}ms, over its budget of {IMPORT_BUDGETS_MS[stage]}ms")
+    if len(over_budget) > 0:
+        sys.exit(1)
+
+
+def get_scales(baseline, scales):
+    """The baseline, then the baseline with each parameter scaled in turn."""
+
+    all_scales = [baseline]
+    for parameter, values in scales.items():
+        for value in values:
+            scale = dict(baseline, **{parameter: value})
+            if scale not in all_scales:
+                all_scales.append(scale)
+
+    return all_scales
+
+
+def get_git_commit():
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+###############   Synthetic analyzers ###############
+
+def get_analyzer(analyzer_folder, scale, duration, n_jobs):
+    """Load the analyzer for `scale` from `analyzer_folder`, generating it if it doesn't exist."""
+
+    analyzer_path = Path(analyzer_folder) / Path(
+        "analyzer_" + "_".join(f"{parameter}{value}" for parameter, value in scale.items()) + f"_duration{duration:g}")
+
+    if analyzer_path.is_dir():
+        sorting_analyzer = load_sorting_analyzer(analyzer_path, load_extensions=False)
+        if all(sorting_analyzer.has_extension(extension) for extension in EXTENSIONS):
+            return sorting_analyzer
+
+    print(f"Generating {analyzer_path.name}...")
+    start_time = time.perf_counter()
+
+    recording, sorting = generate_ground_truth_recording(
+        durations=[duration],
+        sampling_frequency=30000.,
+        num_channels=scale['num_channels'],
+        num_units=scale['num_units'],
+        generate_sorting_kwargs={'firing_rates': scale['spikes_per_unit']/duration, 'refractory_period_ms': 4.0},
+        seed=0,
+    )
+    # use integer unit ids, as most sorters do
+    sorting = sorting.rename_units(np.arange(scale['num_units']))
+
+    # the extensions' modules are imported by spikeinterface as they are computed
+    sorting_analyzer = create_sorting_analyzer(
+        sorting, recording, format="binary_folder", folder=analyzer_path, overwrite=True,
+        sparse=True, sparsity_kwargs={'method': 'radius', 'radius_um': scale['radius_um']})
+    sorting_analyzer.compute(
+        ["random_spikes", "noise_levels", "templates", "spike_amplitudes", "spike_locations", "unit_locations",
+         "correlograms", "template_metrics"],
+        n_jobs=n_jobs)
+    sorting_analyzer.compute(
+        "quality_metrics", metric_names=["num_spikes", "firing_rate", "presence_ratio", "snr", "isi_violation"])
+
+    print(f"Generated in {time.perf_counter() - start_time:.1f}s")
+
+    return load_sorting_analyzer(analyzer_path, load_extensions=False)
+
+
+###############   Benchmarks ###############
+
+def benchmark_imports(repeats):
+    """
+    Time importing `gui`, and running `gui.py --help`, each in a fresh python process.
+    Returns the summary of each, with its budget and whether it was within it.
+    """
+
+    profiler = Profiler(enabled=True)
+
+    import_code = "import time; start_time = time.perf_counter(); import gui; print(time.perf_counter() - start_time)"
+    for _ in range(repeats):
+        # only the import itself, not the python interpreter starting up
+        import_time = subprocess.run([sys.executable, '-c', import_code], capture_output=True, text=True,
+                                     cwd=FAST_CURATE_FOLDER, check=True).stdout
+        profiler.record("import/gui", float(import_time))
+
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, 'gui.py', '--help'], capture_output=True, cwd=FAST_CURATE_FOLDER, check=True)
+        profiler.record("import/gui_help", time.perf_counter() - start_time)
+
+    imports = profiler.report()['stages']
+    for stage, row in imports.items():
+        row['budget_ms'] = IMPORT_BUDGETS_MS[stage]
+        row['within_budget'] = row['p50_ms'] <= IMPORT_BUDGETS_MS[stage]
+        print(f"    - {stage}: {row['p50_ms']:.0f}ms (budget {IMPORT_BUDGETS_MS[stage]}ms)")
+
+    return imports
+
+
+def run_benchmarks(sorting_analyzer, repeats):
+    """Time each part of fast_curate on `sorting_analyzer`. Returns the `Profiler` holding the times."""
+
+    from wrangle import DataForGUI, load_extensions
+
+    profiler = Profiler(enabled=True)
+
+    have_extension, load_times = load_extensions(sorting_analyzer, EXTENSIONS)
+    for extension, load_time in load_times.items():
+        profiler.record(f"load_extension/{extension}", load_time)
+
+    # load the compiled numba functions, so that this isn't timed as part of the first call
+    compute_all_autocorrelograms(np.arange(10), np.zeros(10, dtype=np.int64), 1, sorting_analyzer.sampling_frequency)
+    compute_autocorrelograms(np.arange(10), window_ms=500, bin_ms=5, fs=sorting_analyzer.sampling_frequency)
+    compute_cross_correlograms(np.arange(10), np.array([0, 5, 10]), [[0, 1]], fs=sorting_analyzer.sampling_frequency)
+
+    benchmark_autocorrelograms(sorting_analyzer, profiler)
+
+    with tempfile.TemporaryDirectory() as output_folder:
+
+        cache_folder = Path(output_folder) / Path("cache")
+        for _ in range(repeats):
+            with profiler.time("data_for_gui/no_cache"):
+                DataForGUI(sorting_analyzer, have_extension, profiler=profiler)
+            # the first construction fills the cache, the rest read from it
+            shutil.rmtree(cache_folder, ignore_errors=True)
+            with profiler.time("data_for_gui/cold_cache"):
+                DataForGUI(sorting_analyzer, have_extension, cache_folder)
+            with profiler.time("data_for_gui/warm_cache"):
+                DataForGUI(sorting_analyzer, have_extension, cache_folder)
+            with profiler.time("data_for_gui/lazy"):
+                DataForGUI(sorting_analyzer, have_extension, cache_folder, lazy=True)
+
+        data = DataForGUI(sorting_analyzer, have_extension, cache_folder)
+        unit_indices = range(len(sorting_analyzer.unit_ids))
+        for unit_index in unit_indices:
+            with profiler.time("get_unit_data/eager"):
+                data.get_unit_data(unit_index)
+
+        # units which have not been prefetched, so are computed as they are asked for
+        lazy_data = DataForGUI(sorting_analyzer, have_extension, cache_folder, lazy=True)
+        for unit_index in unit_indices:
+            with profiler.time("get_unit_data/lazy"):
+                lazy_data.get_unit_data(unit_index)
+
+        benchmark_main_window(sorting_analyzer, have_extension, output_folder, cache_folder, profiler)
+
+    return profiler
+
+
+def benchmark_autocorrelograms(sorting_analyzer, profiler):
+
+    spike_vector = sorting_analyzer.sorting.to_spike_vector()
+    fs = sorting_analyzer.sampling_frequency
+
+    # every spike of every unit, not just the random spikes shown in the GUI
+    for unit_index in range(len(sorting_analyzer.unit_ids)):
+        spike_times = spike_vector['sample_index'][spike_vector['unit_index'] == unit_index]
+        with profiler.time("compute_autocorrelograms/per_unit"):
+            compute_autocorrelograms(spike_times, window_ms=500, bin_ms=5, fs=fs)
+
+    with profiler.time("compute_all_autocorrelograms/all_units"):
+        compute_all_autocorrelograms(
+            spike_vector['sample_index'], spike_vector['unit_index'], len(sorting_analyzer.unit_ids), fs)
+
+    # the cross-correlograms of every unit with its 3 nearest units, from every spike
+    sparsity_mask = sorting_analyzer.sparsity.mask if sorting_analyzer.sparsity is not None else \
+        np.ones((len(sorting_analyzer.unit_ids), sorting_analyzer.get_num_channels()), dtype=bool)
+    neighbours = get_neighbour_units(sparsity_mask, sorting_analyzer.get_extension("unit_locations").get_data()[:, :2])
+    pairs = np.unique(np.sort(np.stack([np.repeat(np.arange(len(neighbours)), neighbours.shape[1]), neighbours.ravel()], axis=1), axis=1), axis=0)
+    pairs = pairs[pairs[:, 0] >= 0]
+    unit_order = np.argsort(spike_vector['unit_index'], kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(spike_vector['unit_index'], minlength=len(sorting_analyzer.unit_ids)))])
+    with profiler.time("compute_cross_correlograms/neighbour_pairs"):
+        compute_cross_correlograms(spike_vector['sample_index'][unit_order], offsets, pairs, fs)
+
+
+def benchmark_main_window(sorting_analyzer, have_extension, output_folder, cache_folder, profiler):
+
+    import PyQt6.QtWidgets as QtWidgets
+    from gui import MainWindow
+
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv)
+
+    window = MainWindow(sorting_analyzer, ['sua', 'mua', 'noise'], Path(output_folder), have_extension, cache_folder=cache_folder)
+    window.resize(1600, 800)
+    window.show()
+
+    for unit_index in range(len(sorting_analyzer.unit_ids)):
+        window.unit_index = unit_index
+        unit_data = window.data.get_unit_data(unit_index)
+        with profiler.time("main_window/update_plot"):
+            window.update_plot(unit_data)
+            app.processEvents()
+
+    window.final_labels = {unit_index: (unit_index, 's') for unit_index in range(len(sorting_analyzer.unit_ids))}
+    window.decision_journal.close()
+    with profiler.time("main_window/save_labels"):
+        window.save_labels()
+
+    window.deleteLater()
+    app.processEvents()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+    Wrangling analyzers into curation bundles, without the GUI. Run this where the analyzers
+    are (e.g. on a compute node), then copy the small bundles to wherever you curate.
+"""
+import sys
+from pathlib import Path
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+EXTENSIONS = ['correlograms', 'unit_locations', 'templates', 'spike_amplitudes',
+              'spike_locations', 'quality_metrics', 'template_metrics', 'template_similarity']
+
+
+def main():
+
+    parser = ArgumentParser('Make curation bundles, which fast_curate can open without the analyzers')
+    parser.add_argument(
+        'analyzer_paths',
+        type=Path,
+        nargs='+',
+        help="Paths to the sorting analyzers to make bundles from"
+    )
+    parser.add_argument(
+        '--bundle_folder',
+        type=Path,
+        default='.',
+        help="Folder to save the bundles in. Each is called `<analyzer folder name>.npz`"
+    )
+    parser.add_argument(
+        '--num_workers',
+        type=int,
+        default=None,
+        help="Number of analyzers to wrangle at once. Defaults to the number of CPUs"
+    )
+    parser.add_argument(
+        '--no_cache',
+        action='store_true',
+        help="Don't use or write the cache of wrangled data, stored in `bundle_folder/cache/<analyzer folder name>`"
+    )
+    parser.add_argument(
+        '--full_correlograms',
+        action='store_true',
+        help="Compute the autocorrelograms from every spike, rather than a random sample of spikes from each unit"
+    )
+    parser.add_argument(
+        '--firing_rate_bin_s',
+        type=float,
+        default=None,
+        help="Width, in seconds, of the bins of the firing rate plot. By default, the recording is split into 20 bins"
+    )
+    parser.add_argument(
+        '--density_rasters',
+        action='store_true',
+        help="Also save images of the density of all of each unit's spikes, for the GUI's `--density_rasters`"
+    )
+
+    args = parser.parse_args()
+
+    for analyzer_path in args.analyzer_paths:
+        assert analyzer_path.is_dir(), f"`{analyzer_path}` is not a directory."
+    analyzer_names = [get_bundle_name(analyzer_path) for analyzer_path in args.analyzer_paths]
+    assert len(set(analyzer_names)) == len(analyzer_names), \
+        "The analyzer folders must have different names, so that their bundles have different names."
+
+    args.bundle_folder.mkdir(parents=True, exist_ok=True)
+
+    jobs = {}
+    with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+        for analyzer_path, analyzer_name in zip(args.analyzer_paths, analyzer_names):
+            cache_folder = None
+            if args.no_cache is False:
+                cache_folder = args.bundle_folder / Path("cache") / Path(analyzer_name)
+            bundle_path = args.bundle_folder / Path(f"{analyzer_name}.npz")
+            jobs[executor.submit(make_bundle, analyzer_path, bundle_path, cache_folder,
+                                 args.full_correlograms, args.firing_rate_bin_s, args.density_rasters)] = analyzer_path
+
+        failed = []
+        for job in as_completed(jobs):
+            try:
+                bundle_path = job.result()
+                print(f"Saved {bundle_path}")
+            except Exception as error:
+                print(f"Could not make a bundle from {jobs[job]}: {error}")
+                failed.append(jobs[job])
+
+    if len(failed) > 0:
+        sys.exit(1)
+
+
+def get_bundle_name(analyzer_path):
+
+    return Path(analyzer_path).resolve().name
+
+
+def make_bundle(analyzer_path, bundle_path, cache_folder=None, full_correlograms=False, firing_rate_bin_s=None, density_rasters=False):
+    """Wrangle the analyzer at `analyzer_path`, and save everything the GUI needs to `bundle_path`."""
+
+    from spikeinterface.core import load_sorting_analyzer
+    from wrangle import DataForGUI, load_extensions
+
+    sorting_analyzer = load_sorting_analyzer(analyzer_path, load_extensions=False)
+    have_extension, _ = load_extensions(sorting_analyzer, EXTENSIONS)
+
+    if cache_folder is not None:
+        cache_folder.mkdir(parents=True, exist_ok=True)
+
+    data = DataForGUI(sorting_analyzer, have_extension, cache_folder,
+                      full_correlograms=full_correlograms, firing_rate_bin_s=firing_rate_bin_s, density_rasters=density_rasters)
+    data.save_bundle(bundle_path)
+
+    return bundle_path
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+    An on-disk cache of the wrangled data, so that reopening an analyzer is instant
+"""
+import os
+import json
+import hashlib
+from pathlib import Path
+
+import numpy as np
+
+# Bump this whenever the content of a cached part changes
+CACHE_VERSION = 3
+
+
+class AnalyzerCache:
+    """
+    Each part of the wrangled data (random spikes, amplitudes, correlograms...) is stored
+    in its own npz file, alongside a fingerprint of everything used to compute it: the
+    sorting, the extensions it was computed from and any parameters. A part is only
+    recomputed if its fingerprint has changed. If `cache_folder` is None, nothing is
+    cached and every part is computed.
+    """
+
+    def __init__(self, sorting_analyzer, cache_folder=None, seed=0):
+
+        self.sorting_analyzer = sorting_analyzer
+        self.seed = seed
+
+        self.cache_folder = None
+        if cache_folder is not None and sorting_analyzer.folder is not None:
+            self.cache_folder = Path(cache_folder)
+            self.cache_folder.mkdir(exist_ok=True)
+            self.sorting_fingerprint = get_sorting_fingerprint(sorting_analyzer)
+
+    def get(self, part, extensions, compute_function, **params):
+        """
+        Load `part` from the cache if it was computed from the same inputs. Otherwise
+        compute it with `compute_function`, which returns a dict of arrays, and cache it.
+        """
+
+        if self.cache_folder is None:
+            return compute_function()
+
+        fingerprint = self.get_fingerprint(extensions, **params)
+        part_path = self.cache_folder / Path(f"{part}.npz")
+
+        data = load_part(part_path, fingerprint)
+        if data is None:
+            data = compute_function()
+            save_part(part_path, fingerprint, data)
+
+        return data
+
+    def get_fingerprint(self, extensions, **params):
+
+        fingerprint = {
+            'version': CACHE_VERSION,
+            'seed': self.seed,
+            'sorting': self.sorting_fingerprint,
+            'extensions': {extension: get_extension_fingerprint(self.sorting_analyzer, extension) for extension in extensions},
+            'params': params,
+        }
+        fingerprint_string = json.dumps(fingerprint, sort_keys=True, default=str)
+
+        return hashlib.sha256(fingerprint_string.encode()).hexdigest()
+
+
+def get_folder_fingerprint(folder):
+    """Sizes and modification times of every file in `folder`."""
+
+    folder = Path(folder)
+    if folder.is_dir() is False:
+        return None
+
+    file_stats = []
+    for file_path in sorted(folder.rglob("*")):
+        if file_path.is_file():
+            stat = file_path.stat()
+            file_stats.append((str(file_path.relative_to(folder)), stat.st_size, stat.st_mtime_ns))
+
+    return file_stats
+
+
+def get_sorting_fingerprint(sorting_analyzer):
+
+    return {
+        'unit_ids': [str(unit_id) for unit_id in sorting_analyzer.unit_ids],
+        'num_samples': [sorting_analyzer.get_num_samples(segment_index) for segment_index in range(sorting_analyzer.get_num_segments())],
+        'sampling_frequency': sorting_analyzer.sampling_frequency,
+        'sorting': get_folder_fingerprint(Path(sorting_analyzer.folder) / "sorting"),
+    }
+
+
+def get_extension_fingerprint(sorting_analyzer, extension_name):
+
+    # The extension's params are saved in its folder, so are part of the folder fingerprint.
+    # This avoids loading the extension, which might be large, just to get the params.
+    return get_folder_fingerprint(Path(sorting_analyzer.folder) / "extensions" / extension_name)
+
+
+def load_part(part_path, fingerprint):
+
+    if part_path.is_file() is False:
+        return None
+
+    try:
+        with np.load(part_path, allow_pickle=False) as part_file:
+            if str(part_file['_fingerprint']) != fingerprint:
+                return None
+            return {key: part_file[key] for key in part_file.files if key != '_fingerprint'}
+    except Exception:
+        # A corrupt or unreadable cache just gets rebuilt
+        return None
+
+
+def save_part(part_path, fingerprint, data):
+
+    # Write to a temporary file first, so that a crash never leaves a half-written part
+    temporary_path = part_path.with_suffix(".tmp")
+    with open(temporary_path, 'wb') as part_file:
+        np.savez(part_file, _fingerprint=np.array(fingerprint), **data)
+    os.replace(temporary_path, part_path)
@@ -1,49 +1,460 @@
 import numpy as np
+import numba
 
-def compute_autocorrelograms(spike_times, window_ms, bin_ms, fs):
+
+def get_correlogram_bins(window_ms, bin_ms, fs):
+    """Convert a window and bin width in ms to sizes in samples."""
 
     window_size = int(round(fs*window_ms / 2 * 1e-3))
     bin_size = int(round(fs*bin_ms * 1e-3))
     window_size -= window_size % bin_size
     num_bins = 2*int(window_size/bin_size)
 
-    num_half_bins = int(num_bins // 2)
-    correlograms = np.zeros(num_bins, dtype=np.int64)
+    return window_size, bin_size, num_bins
+
+
+def get_spike_times(spike_vector, segment_num_samples):
+    """The sample index of each spike of a spike vector, with the segments placed one after the other."""
+
+    segment_starts = np.concatenate([[0], np.cumsum(segment_num_samples)]).astype(np.int64)
+
+    return spike_vector['sample_index'].astype(np.int64) + segment_starts[spike_vector['segment_index']]
+
+
+def separate_segments(spike_times, segment_num_samples, gap):
+    """
+    Add `gap` samples between the segments of spike times from `get_spike_times`. The
+    segments aren't contiguous recordings, so a gap wider than the correlogram window
+    stops spikes in different segments from being paired.
+    """
+
+    if len(segment_num_samples) <= 1:
+        return spike_times
+
+    segment_index = np.searchsorted(np.cumsum(segment_num_samples)[:-1], spike_times, side='right')
+
+    return spike_times + segment_index * np.int64(gap)
+
+
+def compute_autocorrelograms(spike_times, window_ms, bin_ms, fs):
+    """Autocorrelogram of a single, time-sorted, spike train."""
+
+    spike_times = np.asarray(spike_times, dtype=np.int64)
+    unit_index = np.zeros(spike_times.size, dtype=np.int64)
+
+    [(correlograms, bins)] = compute_all_autocorrelograms(
+        spike_times, unit_index, num_units=1, fs=fs, window_bin_ms=[(window_ms, bin_ms)], parallel=False)
+
+    return correlograms[0], bins
+
+
+def compute_all_autocorrelograms(sample_index, unit_index, num_units, fs, window_bin_ms=[(50, 2), (500, 5)], parallel=True):
+    """
+    Compute the autocorrelograms of every unit at once, for each (window_ms, bin_ms)
+    pair in `window_bin_ms`. `sample_index` and `unit_index` are the fields of a spike
+    vector, so each unit's spikes must be sorted in time (use `get_spike_times` and
+    `separate_segments` for a spike vector with several segments), otherwise a ValueError
+    is raised. Units are computed in parallel, unless
+    `parallel` is False, which is needed when calling this from several threads at once.
+
+    Returns a list with one `(correlograms, bins)` tuple per window, where `correlograms`
+    is a dense `(num_units, num_bins)` array.
+    """
+
+    window_sizes, bin_sizes, num_bins = np.array(
+        [get_correlogram_bins(window_ms, bin_ms, fs) for window_ms, bin_ms in window_bin_ms], dtype=np.int64).T
+
+    all_correlograms = _count_autocorrelograms(
+        sample_index, unit_index, num_units, window_sizes, bin_sizes, num_bins.max(), parallel=parallel)
+
+    return _get_correlogram_results(all_correlograms, window_sizes, bin_sizes, num_bins, fs)
+
+
+def compute_streamed_autocorrelograms(spike_vector, num_units, fs, window_bin_ms=[(50, 2), (500, 5)], chunk_size=10_000_000):
+    """
+    The same as `compute_all_autocorrelograms`, but for every spike of a (possibly huge)
+    spike vector, as returned by `sorting.to_spike_vector()` or memory-mapped from a
+    sorting's `spikes.npy`. The spikes are read in
+    time-ordered chunks of `chunk_size` spikes, so the memory used doesn't grow with the
+    length of the recording. Spikes in different segments are never paired.
+    """
+
+    window_sizes, bin_sizes, num_bins = np.array(
+        [get_correlogram_bins(window_ms, bin_ms, fs) for window_ms, bin_ms in window_bin_ms], dtype=np.int64).T
+    max_window_size = window_sizes.max()
+
+    all_correlograms = np.zeros((window_sizes.size, num_units, num_bins.max()), dtype=np.int64)
+
+    # the spike vector is sorted by segment, then time
+    num_segments = int(spike_vector['segment_index'][-1]) + 1 if len(spike_vector) > 0 else 0
+    segment_bounds = np.searchsorted(spike_vector['segment_index'], np.arange(num_segments + 1))
+
+    for segment_start, segment_stop in zip(segment_bounds[:-1], segment_bounds[1:]):
+
+        # the spikes at the end of the previous chunk which can pair with spikes in this one
+        previous_times = np.zeros(0, dtype=np.int64)
+        previous_units = np.zeros(0, dtype=np.int64)
+
+        for chunk_start in range(segment_start, segment_stop, chunk_size):
+            chunk = spike_vector[chunk_start:min(chunk_start + chunk_size, segment_stop)]
+            sample_index = np.concatenate([previous_times, chunk['sample_index'].astype(np.int64)])
+            unit_index = np.concatenate([previous_units, chunk['unit_index'].astype(np.int64)])
+            is_new = np.zeros(sample_index.size, dtype=bool)
+            is_new[previous_times.size:] = True
+
+            all_correlograms += _count_autocorrelograms(
+                sample_index, unit_index, num_units, window_sizes, bin_sizes, num_bins.max(), is_new=is_new)
+
+            first_kept = np.searchsorted(sample_index, sample_index[-1] - max_window_size)
+            previous_times = sample_index[first_kept:]
+            previous_units = unit_index[first_kept:]
+
+    return _get_correlogram_results(all_correlograms, window_sizes, bin_sizes, num_bins, fs)
+
+
+def compute_firing_rates(spike_vector, num_units, segment_num_samples, bin_size, chunk_size=10_000_000):
+    """
+    The firing rate (in spikes per sample) of every unit in bins of `bin_size` samples,
+    aligned to the start of the recording. Segments are placed one after the other.
+    The spike vector is read in chunks of `chunk_size` spikes, and each chunk is binned
+    with a single bincount over (unit, time bin).
+
+    Returns the `(num_units, num_bins)` rates and the `num_bins + 1` bin edges, in samples.
+    """
+
+    total_samples = int(np.sum(segment_num_samples))
+    num_bins = max(int(np.ceil(total_samples / bin_size)), 1)
+
+    counts = np.zeros(num_units * num_bins, dtype=np.int64)
+    for chunk_start in range(0, len(spike_vector), chunk_size):
+        chunk = spike_vector[chunk_start:chunk_start + chunk_size]
+        spike_times = get_spike_times(chunk, segment_num_samples)
+        time_bins = np.minimum(spike_times // bin_size, num_bins - 1)
+        counts += np.bincount(chunk['unit_index'] * num_bins + time_bins, minlength=num_units * num_bins)
+
+    bin_edges = np.minimum(np.arange(num_bins + 1) * bin_size, total_samples)
+    firing_rates = counts.reshape(num_units, num_bins) / np.diff(bin_edges)
+
+    return firing_rates, bin_edges
+
+
+def get_value_ranges(values, unit_index, num_units, percentiles=(1, 99), padding=0.1):
+    """
+    The range of each unit's `values`, between the given percentiles and padded by
+    `padding` of its width on each side, so that a few outliers don't squash the rest.
+    Units without any values get the range (0, 1).
+    """
+
+    values = np.nan_to_num(np.asarray(values, dtype=np.float64))
+    sort_order = np.lexsort((values, unit_index))
+    sorted_values = values[sort_order]
+
+    num_values = np.bincount(unit_index, minlength=num_units)
+    offsets = np.concatenate([[0], np.cumsum(num_values)[:-1]])
+    has_values = num_values > 0
+    last_index = np.maximum(num_values - 1, 0)
+
+    value_ranges = np.tile(np.array([0., 1.]), (num_units, 1))
+    for column, percentile in enumerate(percentiles):
+        positions = offsets + np.round(last_index * percentile / 100).astype(np.int64)
+        value_ranges[has_values, column] = sorted_values[positions[has_values]]
+
+    widths = np.maximum(value_ranges[:, 1] - value_ranges[:, 0], 1e-6)
+    value_ranges[:, 0] -= padding * widths
+    value_ranges[:, 1] += padding * widths
+
+    return value_ranges
+
+
+def compute_spike_densities(spike_vector, values, value_ranges, segment_num_samples, num_time_bins, num_value_bins, field=None, chunk_size=10_000_000):
+    """
+    A 2D histogram, for every unit, of each spike's value (e.g. its amplitude or depth)
+    against time. Unit i's values are binned between `value_ranges[i]`, and values outside
+    the range are put in the edge bins. `values` holds one value per spike of the spike
+    vector (or a structured array, of which `field` is used) and, like the spike vector,
+    is read in chunks of `chunk_size` spikes, so can be a memmap or zarr array.
+
+    Returns the `(num_units, num_time_bins, num_value_bins)` counts and the
+    `num_time_bins + 1` time bin edges, in samples.
+    """
+
+    num_units = len(value_ranges)
+    total_samples = max(int(np.sum(segment_num_samples)), 1)
+
+    value_starts = value_ranges[:, 0].astype(np.float64)
+    value_widths = np.maximum(value_ranges[:, 1] - value_ranges[:, 0], 1e-6).astype(np.float64)
+
+    counts = np.zeros(num_units * num_time_bins * num_value_bins, dtype=np.int64)
+    for chunk_start in range(0, len(spike_vector), chunk_size):
+        chunk = spike_vector[chunk_start:chunk_start + chunk_size]
+        chunk_values = np.asarray(values[chunk_start:chunk_start + chunk_size])
+        if field is not None:
+            chunk_values = chunk_values[field]
+        chunk_values = np.nan_to_num(chunk_values.astype(np.float64))
+
+        spike_times = get_spike_times(chunk, segment_num_samples)
+        time_bins = np.minimum(spike_times * num_time_bins // total_samples, num_time_bins - 1)
+
+        unit_index = chunk['unit_index']
+        value_bins = np.floor((chunk_values - value_starts[unit_index]) / value_widths[unit_index] * num_value_bins)
+        value_bins = np.clip(value_bins, 0, num_value_bins - 1).astype(np.int64)
+
+        counts += np.bincount((unit_index * num_time_bins + time_bins) * num_value_bins + value_bins,
+                              minlength=counts.size)
+
+    bin_edges = np.arange(num_time_bins + 1) * total_samples / num_time_bins
+
+    return counts.reshape(num_units, num_time_bins, num_value_bins), bin_edges
+
 
-    start_j = 0
-    for i in range(spike_times.size):
-        for j in range(start_j, spike_times.size):
+def compute_template_similarity(templates, sparsity_mask):
+    """
+    Cosine similarity between the templates of every pair of units, computed in one matrix
+    product. `templates` has shape (num_units, num_samples, num_channels), and each unit
+    only uses the channels in its row of `sparsity_mask`.
+    """
 
-            if i == j:
-                continue
+    num_units = templates.shape[0]
+    flat_templates = (templates * sparsity_mask[:, np.newaxis, :]).reshape(num_units, -1).astype(np.float32)
 
-            diff = spike_times[i] - spike_times[j]
+    norms = np.linalg.norm(flat_templates, axis=1)
+    norms[norms == 0] = 1
+    flat_templates /= norms[:, np.newaxis]
 
-            # When the diff is exactly the window size, keep going
-            # without iterating start_j in case this spike also has
-            # other diffs with other units that == window size.
-            if diff == window_size:
-                continue
+    return flat_templates @ flat_templates.T
 
-            # if the time of spike i is more than window size later than
-            # spike j, then spike i + 1 will also be more than a window size
-            # later than spike j. Iterate the start_j and check the next spike.
-            if diff > window_size:
-                start_j += 1
-                continue
 
-            # If the time of spike i is more than a window size earlier
-            # than spike j, then all following j spikes will be even later
-            # i spikes and so all more than a window size earlier. So move
-            # onto the next i.
-            if diff < -window_size:
+def order_by_similarity(similarity, first_unit_index=0):
+    """
+    Greedy nearest-neighbour ordering: starting from `first_unit_index`, go to the most
+    similar unit which hasn't been visited yet.
+    """
+
+    num_units = similarity.shape[0]
+    visited = np.zeros(num_units, dtype=bool)
+    order = np.zeros(num_units, dtype=np.int64)
+
+    unit_index = first_unit_index
+    for position in range(num_units):
+        order[position] = unit_index
+        visited[unit_index] = True
+        if position < num_units - 1:
+            unit_index = np.argmax(np.where(visited, -np.inf, similarity[unit_index]))
+
+    return order
+
+
+def get_neighbour_units(sparsity_mask, unit_locations=None, num_neighbours=3):
+    """
+    The `num_neighbours` nearest units to each unit, out of the units which share at least
+    one sparse channel with it. Units are ranked by the distance between their
+    `unit_locations` if given, and otherwise by how many channels they share. Returns a
+    `(num_units, num_neighbours)` array of unit indices, padded with -1.
+    """
+
+    sparsity_mask = np.asarray(sparsity_mask, dtype=np.float32)
+
+    shared_channels = sparsity_mask @ sparsity_mask.T
+    if unit_locations is not None:
+        unit_locations = np.asarray(unit_locations, dtype=np.float64)
+        distances = np.linalg.norm(unit_locations[:, np.newaxis, :] - unit_locations[np.newaxis, :, :], axis=2)
+    else:
+        distances = -shared_channels.astype(np.float64)
+    distances[shared_channels == 0] = np.inf
+    np.fill_diagonal(distances, np.inf)
+
+    neighbours = np.argsort(distances, axis=1, kind='stable')[:, :num_neighbours]
+    neighbours[np.take_along_axis(distances, neighbours, axis=1) == np.inf] = -1
+
+    return neighbours
+
+
+def compute_cross_correlograms(spike_times, offsets, pairs, fs, window_ms=50, bin_ms=2, parallel=True):
+    """
+    The cross-correlograms of only the given `pairs` of units, rather than of every pair.
+    Unit i's time-sorted spikes are `spike_times[offsets[i]:offsets[i+1]]`. Each pair's two
+    spike trains are merged in a single sweep, so a pair costs the number of its spikes
+    plus the number of spike pairs in the window. Pairs are computed in parallel, unless
+    `parallel` is False, which is needed when calling this from a thread.
+
+    Returns the `(num_pairs, num_bins)` correlograms, which count the spikes of `pairs[p, 1]`
+    relative to the spikes of `pairs[p, 0]`, and the bins in ms.
+    """
+
+    window_size, bin_size, num_bins = get_correlogram_bins(window_ms, bin_ms, fs)
+
+    spike_times = np.asarray(spike_times, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    _check_units_sorted(spike_times, offsets)
+
+    if parallel:
+        compute_function = _compute_cross_correlograms_numba
+    else:
+        compute_function = _compute_cross_correlograms_numba_serial
+    correlograms = compute_function(spike_times, offsets, pairs, window_size, bin_size, num_bins)
+
+    bins = np.arange(-window_size, window_size + bin_size, bin_size) * 1e3/fs
+
+    return correlograms, bins
+
+
+def _count_autocorrelograms(sample_index, unit_index, num_units, window_sizes, bin_sizes, max_num_bins, is_new=None, parallel=True):
+    """
+    Count the spike pairs in each autocorrelogram bin. If `is_new` is given, only pairs
+    which include at least one new spike are counted. The new spikes must all be later
+    than the old ones.
+    """
+
+    sample_index = np.asarray(sample_index, dtype=np.int64)
+    unit_index = np.asarray(unit_index, dtype=np.int64)
+
+    # a stable sort keeps each unit's spikes in time order
+    order = np.argsort(unit_index, kind='stable')
+    spike_times = sample_index[order]
+    offsets = np.zeros(num_units + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(unit_index, minlength=num_units)[:num_units])
+
+    _check_units_sorted(spike_times, offsets)
+
+    # each unit's new spikes are at the end of its slice
+    if is_new is None:
+        new_offsets = offsets[:-1].copy()
+    else:
+        new_offsets = offsets[1:] - np.bincount(unit_index[is_new], minlength=num_units)[:num_units]
+
+    if parallel:
+        compute_function = _compute_autocorrelograms_numba
+    else:
+        compute_function = _compute_autocorrelograms_numba_serial
+
+    return compute_function(spike_times, offsets, new_offsets, window_sizes, bin_sizes, max_num_bins)
+
+
+def _check_units_sorted(spike_times, offsets):
+    """
+    The numba kernels don't check their indices, so a unit whose spikes aren't sorted in
+    time would make them write outside the correlograms.
+    """
+
+    # the times can only go back where one unit's spikes end and the next unit's begin
+    decreasing = np.flatnonzero(np.diff(spike_times) < 0) + 1
+    if not np.isin(decreasing, offsets).all():
+        raise ValueError("Each unit's spike times must be sorted. For a spike vector with several segments, place the segments one after the other with `get_spike_times`.")
+
+
+def _get_correlogram_results(all_correlograms, window_sizes, bin_sizes, num_bins, fs):
+
+    results = []
+    for window_index, (window_size, bin_size) in enumerate(zip(window_sizes, bin_sizes)):
+        correlograms = np.ascontiguousarray(
+            all_correlograms[window_index, :, :num_bins[window_index]])
+        bins = np.arange(-window_size, window_size + bin_size, bin_size) * 1e3/fs
+        results.append((correlograms, bins))
+
+    return results
+
+
+@numba.jit(nopython=True, nogil=True, cache=True, parallel=True)
+def _compute_autocorrelograms_numba(spike_times, offsets, new_offsets, window_sizes, bin_sizes, max_num_bins):
+
+    num_units = offsets.size - 1
+    correlograms = np.zeros((window_sizes.size, num_units, max_num_bins), dtype=np.int64)
+
+    for unit_index in numba.prange(num_units):
+        _add_unit_autocorrelograms(spike_times, offsets, new_offsets, window_sizes, bin_sizes, unit_index, correlograms)
+
+    return correlograms
+
+
+# numba's default threading layer can't run parallel functions from several Python threads
+# at once, so this serial version is used when the caller is already in a thread.
+@numba.jit(nopython=True, nogil=True, cache=True)
+def _compute_autocorrelograms_numba_serial(spike_times, offsets, new_offsets, window_sizes, bin_sizes, max_num_bins):
+
+    num_units = offsets.size - 1
+    correlograms = np.zeros((window_sizes.size, num_units, max_num_bins), dtype=np.int64)
+
+    for unit_index in range(num_units):
+        _add_unit_autocorrelograms(spike_times, offsets, new_offsets, window_sizes, bin_sizes, unit_index, correlograms)
+
+    return correlograms
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def _add_unit_autocorrelograms(spike_times, offsets, new_offsets, window_sizes, bin_sizes, unit_index, correlograms):
+
+    num_windows = window_sizes.size
+    max_window_size = window_sizes.max()
+
+    start = offsets[unit_index]
+    new_start = new_offsets[unit_index]
+    stop = offsets[unit_index + 1]
+    for i in range(start, stop):
+        # only count the pairs which include a new spike
+        for j in range(max(i + 1, new_start), stop):
+
+            # spike j is later than spike i, so the pair (j, i) has a positive
+            # diff and the pair (i, j) has the same diff but negative.
+            diff = spike_times[j] - spike_times[i]
+            if diff > max_window_size:
                 break
 
-            bin = diff // bin_size
+            for window_index in range(num_windows):
+                window_size = window_sizes[window_index]
+                bin_size = bin_sizes[window_index]
+                num_half_bins = window_size // bin_size
+
+                # a diff of exactly -window_size lands in the first bin,
+                # while +window_size is outside the last bin.
+                if diff > window_size:
+                    continue
+                correlograms[window_index, unit_index, num_half_bins + (-diff) // bin_size] += 1
+                if diff < window_size:
+                    correlograms[window_index, unit_index, num_half_bins + diff // bin_size] += 1
+
+
+@numba.jit(nopython=True, nogil=True, cache=True, parallel=True)
+def _compute_cross_correlograms_numba(spike_times, offsets, pairs, window_size, bin_size, num_bins):
+
+    correlograms = np.zeros((pairs.shape[0], num_bins), dtype=np.int64)
+
+    for pair_index in numba.prange(pairs.shape[0]):
+        _add_pair_cross_correlogram(spike_times, offsets, pairs, window_size, bin_size, pair_index, correlograms)
+
+    return correlograms
 
-            correlograms[num_half_bins + bin] += 1
 
-    return correlograms, np.arange(-window_size, window_size + bin_size, bin_size)* 1e3/fs
+@numba.jit(nopython=True, nogil=True, cache=True)
+def _compute_cross_correlograms_numba_serial(spike_times, offsets, pairs, window_size, bin_size, num_bins):
 
+    correlograms = np.zeros((pairs.shape[0], num_bins), dtype=np.int64)
 
+    for pair_index in range(pairs.shape[0]):
+        _add_pair_cross_correlogram(spike_times, offsets, pairs, window_size, bin_size, pair_index, correlograms)
 
+    return correlograms
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def _add_pair_cross_correlogram(spike_times, offsets, pairs, window_size, bin_size, pair_index, correlograms):
+
+    num_half_bins = window_size // bin_size
+
+    start_1, stop_1 = offsets[pairs[pair_index, 0]], offsets[pairs[pair_index, 0] + 1]
+    start_2, stop_2 = offsets[pairs[pair_index, 1]], offsets[pairs[pair_index, 1] + 1]
+
+    # the first spike of the second unit which is in the window of the current spike of
+    # the first unit. Both trains are sorted, so this only ever moves forward.
+    window_start = start_2
+    for i in range(start_1, stop_1):
+        while window_start < stop_2 and spike_times[window_start] - spike_times[i] < -window_size:
+            window_start += 1
+
+        for j in range(window_start, stop_2):
+            diff = spike_times[j] - spike_times[i]
+            # as for the autocorrelograms, -window_size is in the first bin and
+            # +window_size is outside the last bin
+            if diff >= window_size:
+                break
+            correlograms[pair_index, num_half_bins + diff // bin_size] += 1
@@ -5,20 +5,26 @@ import sys
 from pathlib import Path
 from argparse import ArgumentParser
 
-import pandas as pd
 import PyQt6.QtWidgets as QtWidgets
+import PyQt6.QtCore as QtCore
 import numpy as np
-import pyqtgraph as pg
 
-import spikeinterface.full as si
-from wrangle import DataForGUI
+from journal import DecisionJournal, replay_journal, add_label, undo_label
+from profiling import Profiler
+from prelabel import PRELABEL_PREFIX, load_prelabel_rules, prelabel_units
+from sessions import SessionQueue, load_manifest
 
-pg.setConfigOption('background', 'w')
+# pandas, pyqtgraph and numba (through wrangle) take most of a second to import, so are
+# only imported once the arguments have been checked
 
 color_1 = (78, 121, 167)
 color_2 = (242, 142, 43)
 color_3 = (89, 161, 79)
 
+# In density mode, the random spikes are drawn over the rasters' images once they're
+# zoomed in to less than this fraction of the recording
+DENSITY_DETAIL_FRACTION = 0.1
+
 
 def check_labels(labels):
     first_letters = [label[0] for label in labels]
@@ -28,6 +34,30 @@ def check_labels(labels):
     assert 'q' not in first_letters, "The key 'q' is reserved for (q)uit. Please use a label which does not begin with 'w'"
 
 
+def check_output_folder(output_folder, resume):
+    """Make `output_folder`, and check that it's ok to overwrite any labels already in it."""
+
+    output_folder = Path(output_folder)
+    assert Path(output_folder.parent).is_dir(
+    ), f"Parent folder of `output_folder` {output_folder} must already exist."
+    output_folder.mkdir(exist_ok=True)
+
+    final_result_path = output_folder / Path("just_labels.csv")
+    if final_result_path.is_file() and resume is False:
+        yes_no_decision = "banana"
+        while (yes_no_decision in ["y", "n"]) == False:
+            yes_no_decision = input(
+                f'The `output_folder` {output_folder} already contains labelled output in `just_labels.csv`. Continuing will overwrite this file. Continue? (y/n) ')
+            if yes_no_decision == "n":
+                sys.exit()
+            elif yes_no_decision == "y":
+                final_result_path.unlink()
+                results_with_metrics_path = output_folder / \
+                    Path("decision_data_with_metics.csv")
+                if results_with_metrics_path.is_file():
+                    results_with_metrics_path.unlink()
+
+
 def main():
 
     parser = ArgumentParser('Do a curation, quickly!')
@@ -37,6 +67,18 @@ def main():
         default='.',
         help="Path to a sorting analyzer that you'd like to curate"
     )
+    parser.add_argument(
+        '--bundle_path',
+        type=Path,
+        default=None,
+        help="Path to a curation bundle made by `batch.py`, to curate instead of an analyzer"
+    )
+    parser.add_argument(
+        '--manifest',
+        type=Path,
+        default=None,
+        help="Path to a json list of sessions to curate one after the other, each with an `output_folder` and an `analyzer_path` or `bundle_path`"
+    )
     parser.add_argument(
         '--labels',
         nargs='*',
@@ -47,60 +89,176 @@ def main():
         default='.',
         help="Path to folder for the labelled output"
     )
+    parser.add_argument(
+        '--no_cache',
+        action='store_true',
+        help="Don't use or write the cache of wrangled data, stored in `output_folder/cache`"
+    )
+    parser.add_argument(
+        '--lazy',
+        action='store_true',
+        help="Compute each unit's data when it is first shown, prefetching the next few units in the background"
+    )
+    parser.add_argument(
+        '--parquet',
+        action='store_true',
+        help="Also save the labels and metrics as `decision_data_with_metics.parquet`"
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help="Carry on from a previous session, using the decisions in `output_folder/decision_data_cache.csv`"
+    )
+    parser.add_argument(
+        '--full_correlograms',
+        action='store_true',
+        help="Compute the autocorrelograms from every spike, rather than a random sample of spikes from each unit"
+    )
+    parser.add_argument(
+        '--firing_rate_bin_s',
+        type=float,
+        default=None,
+        help="Width, in seconds, of the bins of the firing rate plot. By default, the recording is split into 20 bins"
+    )
+    parser.add_argument(
+        '--density_rasters',
+        action='store_true',
+        help="Show the amplitude and location rasters as images of the density of all of each unit's spikes, rather than as a random sample of spikes. Zoom in to see the sampled spikes too"
+    )
+    parser.add_argument(
+        '--num_neighbours',
+        type=int,
+        default=3,
+        help="Number of the nearest units to show the cross-correlograms with. Pass 0 to hide them"
+    )
+    parser.add_argument(
+        '--order',
+        choices=['index', 'depth', 'similarity'],
+        default='index',
+        help="The order to curate the units in: the sorting's order, by depth along the probe, or with units with similar templates next to each other"
+    )
+    parser.add_argument(
+        '--prelabel',
+        type=Path,
+        default=None,
+        help="Path to a json file of rules on the metrics, used to label the obvious units before the GUI opens. Only the other units are shown"
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help="Time the loading, wrangling and each unit switch, and save a report to `output_folder/profile.json` and `profile.csv`"
+    )
 
     args = parser.parse_args()
 
-    assert Path(args.analyzer_path).is_dir(
-    ), "`analyzer_path` must be a directory."
+    # The first session is opened as if it had been passed on its own. The rest are
+    # prepared in the background while it is curated.
+    sessions = None
+    if args.manifest is not None:
+        sessions = load_manifest(args.manifest)
+        assert len(sessions) > 0, "The manifest doesn't contain any sessions."
+        first_session = sessions.pop(0)
+        args.analyzer_path = first_session.get('analyzer_path', args.analyzer_path)
+        args.bundle_path = first_session.get('bundle_path')
+        args.output_folder = first_session['output_folder']
+
+    if args.bundle_path is not None:
+        assert args.bundle_path.is_file(), "`bundle_path` must be a curation bundle file."
+    else:
+        assert Path(args.analyzer_path).is_dir(
+        ), "`analyzer_path` must be a directory."
     check_labels(args.labels)
+    assert args.num_neighbours >= 0, "`num_neighbours` can't be negative."
 
-    output_folder = Path(args.output_folder)
-    assert Path(output_folder.parent).is_dir(
-    ), "Parent folder of `output_folder` must already exist."
-    output_folder.mkdir(exist_ok=True)
+    prelabel_rules = None
+    if args.prelabel is not None:
+        assert args.prelabel.is_file(), "`prelabel` must be a json file of prelabelling rules."
+        prelabel_rules = load_prelabel_rules(args.prelabel, args.labels)
 
-    final_result_path = output_folder / Path("just_labels.csv")
-    if final_result_path.is_file():
-        yes_no_decision = "banana"
-        while (yes_no_decision in ["y", "n"]) == False:
-            yes_no_decision = input(
-                'The `output_folder` already contains labelled output in `just_labels.csv`. Continuing will overwrite this file. Continue? (y/n) ')
-            if yes_no_decision == "n":
-                sys.exit()
-            elif yes_no_decision == "y":
-                final_result_path.unlink()
-                results_with_metrics_path = output_folder / \
-                    Path("decision_data_with_metics.csv")
-                if results_with_metrics_path.is_file():
-                    results_with_metrics_path.unlink()
+    output_folder = Path(args.output_folder)
+    resume = args.resume
+    if sessions is None:
+        if args.resume:
+            assert (output_folder / Path("decision_data_cache.csv")).is_file(
+            ), "Can only `--resume` if `output_folder` contains `decision_data_cache.csv` from a previous session."
+    else:
+        # with a manifest, only the sessions which have been started are resumed
+        resume = args.resume and (output_folder / Path("decision_data_cache.csv")).is_file()
+        for session in sessions:
+            check_output_folder(session['output_folder'], args.resume and (
+                session['output_folder'] / Path("decision_data_cache.csv")).is_file())
+    check_output_folder(output_folder, resume)
 
     print(
         f"Your labels are {args.labels}. Your keystroke options are:\n\n\tq: quit\n\tu: undo")
     for label in args.labels:
         print(f"\t{label[0]}: {label}")
+    if sessions is not None:
+        print(f"\tEnter: save this session and go to the next one ({len(sessions)} more)")
+
+    session_queue = None
+    if sessions is not None:
+        session_queue = SessionQueue(sessions, args.no_cache, args.full_correlograms, args.firing_rate_bin_s, args.density_rasters)
+
+    profiler = Profiler(enabled=args.profile)
+
+    with profiler.time("startup/import_wrangle"):
+        from wrangle import DataForGUI, load_extensions
+
+    # A bundle has already been wrangled, so doesn't need spikeinterface or the analyzer
+    data = None
+    sorting_analyzer = None
+    cache_folder = None
+    if args.bundle_path is not None:
+        print("\nLoading curation bundle...")
+        with profiler.time("startup/load_bundle"):
+            data = DataForGUI.from_bundle(args.bundle_path)
+        have_extension = data.have_extension
+        print(f"Made from the analyzer at {data.analyzer_folder}\n")
+        if args.density_rasters and data.density_bins is None:
+            print("This bundle was made without `--density_rasters`, so the rasters will show the sampled spikes.\n")
+    else:
+        from spikeinterface.core import load_sorting_analyzer
+
+        print("\nLoading data...")
+        with profiler.time("startup/load_sorting_analyzer"):
+            sorting_analyzer = load_sorting_analyzer(
+                args.analyzer_path, load_extensions=False)
+        extension_names = ['correlograms', 'unit_locations', 'templates', 'spike_amplitudes', 'spike_locations', 'quality_metrics', 'template_metrics']
+        if args.order == "similarity":
+            extension_names.append('template_similarity')
+        have_extension, load_times = load_extensions(sorting_analyzer, extension_names)
 
-    print("\nLoading data...")
-    have_extension = {}
-    sorting_analyzer = si.load_sorting_analyzer(
-        args.analyzer_path, load_extensions=False)
-    missing_an_extension = False
-    for extension in ['correlograms', 'unit_locations', 'templates', 'spike_amplitudes', 'spike_locations', 'quality_metrics', 'template_metrics']:
-        have_extension[extension] = True
-        try:
-            sorting_analyzer.load_extension(extension)
-        except:
-            if missing_an_extension is False:
-                print("")
-            missing_an_extension = True
-            have_extension[extension] = False
-            print(
-                f"    - No {extension} found. Will not display certain plots.")
-    if missing_an_extension:
         print("")
+        for extension, loaded in have_extension.items():
+            if loaded:
+                print(f"    - Loaded {extension} in {load_times[extension]:.2f}s")
+                profiler.record(f"startup/load_extension/{extension}", load_times[extension])
+            else:
+                print(
+                    f"    - No {extension} found. Will not display certain plots.")
+        print("")
+
+        if args.no_cache is False:
+            cache_folder = output_folder / Path("cache")
+
+    profiler.info = {
+        'analyzer_path': str(args.analyzer_path if data is None else args.bundle_path),
+        'num_units': len(sorting_analyzer.unit_ids if data is None else data.unit_ids),
+        'format': sorting_analyzer.format if data is None else 'bundle',
+        'have_extension': have_extension,
+        'cache': cache_folder is not None,
+        'lazy': args.lazy,
+        'full_correlograms': args.full_correlograms,
+        'order': args.order,
+    }
 
     app = QtWidgets.QApplication(sys.argv)
-    window = MainWindow(sorting_analyzer, args.labels,
-                        args.output_folder, have_extension)
+    window = MainWindow(sorting_analyzer, args.labels, output_folder, have_extension, cache_folder=cache_folder,
+                        lazy=args.lazy, save_parquet=args.parquet, resume=resume, full_correlograms=args.full_correlograms,
+                        firing_rate_bin_s=args.firing_rate_bin_s, order=args.order, prelabel_rules=prelabel_rules, profiler=profiler,
+                        data=data, sessions=session_queue, resume_sessions=args.resume, density_rasters=args.density_rasters,
+                        num_neighbours=args.num_neighbours)
     window.resize(1600, 800)
     window.show()
 
@@ -108,21 +266,35 @@ def main():
 
 
 class MainWindow(QtWidgets.QMainWindow):
-    def __init__(self, sorting_analyzer, labels, output_folder, have_extension):
 
-        self.have_extension = have_extension
-        self.data = DataForGUI(sorting_analyzer, have_extension)
-        self.fs = sorting_analyzer.sampling_frequency
-        self.first_letters = [label[0] for label in labels]
-        self.output_folder = output_folder
-        self.curated_ids = []
+    # emitted, from the background thread, with the Future of the neighbours' cross-correlograms
+    neighbour_correlograms_ready = QtCore.pyqtSignal(object)
 
-        ############### Intialise widgets and do some layout ###############
-        self.decision_counter = 0
-        self.id_1_tracker = 0
-        # self.good_units = list(get_good_units(sorting_analyzer).index)
-        self.good_units = sorting_analyzer.unit_ids
-        self.unit_id = self.good_units[0]
+    def __init__(self, sorting_analyzer, labels, output_folder, have_extension, cache_folder=None, lazy=False, save_parquet=False, resume=False, full_correlograms=False, firing_rate_bin_s=None, order="index", prelabel_rules=None, profiler=None, data=None, sessions=None, resume_sessions=False, density_rasters=False, num_neighbours=3):
+
+        import pyqtgraph as pg
+        from wrangle import DataForGUI
+
+        pg.setConfigOption('background', 'w')
+
+        self.profiler = profiler if profiler is not None else Profiler()
+        # `data` is given when curating a bundle, which has already been wrangled
+        if data is None:
+            data = DataForGUI(sorting_analyzer, have_extension, cache_folder, lazy=lazy, full_correlograms=full_correlograms, firing_rate_bin_s=firing_rate_bin_s, density_rasters=density_rasters, profiler=self.profiler)
+        self.labels = labels
+        self.first_letters = [label[0] for label in labels]
+        self.save_parquet = save_parquet
+        self.order = order
+        self.prelabel_rules = prelabel_rules
+        # the `SessionQueue` of sessions to curate after this one, and whether to resume them
+        self.sessions = sessions
+        self.resume_sessions = resume_sessions
+        self.num_neighbours = num_neighbours
+        self.neighbour_correlograms_future = None
+        # whether to show the density images, in the sessions whose data has them
+        self.use_density_rasters = density_rasters
+
+        self.start_session(data, output_folder, resume)
 
         super().__init__()
 
@@ -161,16 +333,109 @@ class MainWindow(QtWidgets.QMainWindow):
         layout.addWidget(self.amp_raster_widget, 2, 0, 1, 2)
         layout.addWidget(self.binned_spikes_widget, 2, 3)
 
+        # the cross-correlograms with the nearest units are stacked in an extra column
+        self.neighbour_widgets = []
+        if self.num_neighbours > 0:
+            neighbour_layout = QtWidgets.QVBoxLayout()
+            neighbour_layout.setContentsMargins(0, 0, 0, 0)
+            for _ in range(self.num_neighbours):
+                neighbour_widget = pg.PlotWidget(self)
+                neighbour_layout.addWidget(neighbour_widget)
+                self.neighbour_widgets.append(neighbour_widget)
+            neighbours_widget = QtWidgets.QWidget()
+            neighbours_widget.setLayout(neighbour_layout)
+            layout.addWidget(neighbours_widget, 0, 4, 3, 1)
+            layout.setColumnStretch(4, 1)
+            self.neighbour_correlograms_ready.connect(self.update_neighbour_correlograms)
+
         print("Starting plot...")
 
-        self.initialise_plot()
+        with self.profiler.time("startup/initialise_plot"):
+            self.initialise_plot()
         self.initialise_choice_df()
 
+        for raster_widget in [self.amp_raster_widget, self.loc_raster_widget]:
+            raster_widget.sigXRangeChanged.connect(self.update_raster_detail)
+
         self.setCentralWidget(widget)
 
+    def start_session(self, data, output_folder, resume):
+        """Set up the curation state for a session, from its wrangled `data`."""
+
+        self.data = data
+        self.have_extension = data.have_extension
+        self.fs = data.sampling_frequency
+        # densities are only wrangled (or saved in the bundle) if they were asked for, and
+        # a bundle's densities are only shown if `--density_rasters` is passed to the GUI too
+        self.density_rasters = self.use_density_rasters and data.density_bins is not None
+        self.output_folder = output_folder
+        self.curated_ids = []
+        # unit_index: (decision index, keystroke) of each unit's latest label
+        self.final_labels = {}
+        # the (unit index, previous label) of each label given in the GUI, in order, so that
+        # undo always restores the latest unit's previous label
+        self.labelled_units = []
+
+        self.decision_counter = 0
+        self.id_1_tracker = 0
+        # self.good_units = list(get_good_units(sorting_analyzer).index)
+        # DataForGUI stores everything by unit index, which need not equal the unit id
+        self.unit_order = self.data.get_unit_order(self.order)
+        # units labelled by the prelabel rules, in this or a previous session, aren't shown,
+        # unless every unit was prelabelled
+        self.prelabelled_units = set()
+        self.new_prelabels = []
+
+        self.resume = resume
+        if resume:
+            self.resume_session()
+        if self.prelabel_rules is not None:
+            with self.profiler.time("startup/prelabel"):
+                self.prelabel(self.prelabel_rules)
+
+        self.initialise_queue()
+
+    def next_session(self):
+        """Save this session, then show the next one in the same window."""
+
+        if self.sessions is None or self.sessions.has_next() is False:
+            print("This is the last session. Press q to save and quit.")
+            return
+
+        self.finish_session()
+
+        print("Loading the next session...")
+        with self.profiler.time("session/wait_for_next"):
+            data, output_folder = self.sessions.next()
+        resume = self.resume_sessions and (output_folder / Path("decision_data_cache.csv")).is_file()
+        self.start_session(data, output_folder, resume)
+
+        for plot_widget in [self.amp_raster_widget, self.loc_raster_widget, self.spike_locs_widget, self.max_template_widget, self.correlogram_widget,
+                            self.correlogram_zoom_widget, self.unit_locations_widget, self.all_templates_widget, self.binned_spikes_widget] + self.neighbour_widgets:
+            plot_widget.clear()
+        self.initialise_plot()
+        self.initialise_choice_df()
+
+        print(f"Curating {output_folder}. {len(self.sessions.sessions)} sessions left after this one.")
+
+    def finish_session(self):
+
+        print("Saving final curation...")
+        try:
+            self.decision_journal.close()
+        except RuntimeError as error:
+            print(f"Warning: {error}. `decision_data_cache.csv` is missing some decisions, so can't be used to resume.")
+        with self.profiler.time("shutdown/save_labels"):
+            self.save_labels()
+        self.profiler.save(self.output_folder)
+        # so that each session's report only holds its own times
+        self.profiler.reset()
+
     def initialise_plot(self):
 
-        unit_data = self.data.get_unit_data(self.unit_id)
+        import pyqtgraph as pg
+
+        unit_data = self.data.get_unit_data(self.unit_index)
 
         self.unit_locations_widget.setXRange(
             self.data.unit_xmin, self.data.unit_xmax)
@@ -210,62 +475,150 @@ class MainWindow(QtWidgets.QMainWindow):
         self.loc_raster_widget.setLabels(
             title="Location of spikes in time", bottom="time (s)", left="y-Location (um)")
 
+        # In density mode, each raster is an image of all the unit's spikes, which costs
+        # the same to draw however many spikes there are. The sampled spikes are hidden
+        # until zoomed in.
+        self.amps_density_image = None
+        self.locs_density_image = None
+        if self.density_rasters:
+            for raster_widget, raster_plot, color, name in [(self.amp_raster_widget, self.amps_raster_plot, color_3, 'amps_density_image'),
+                                                            (self.loc_raster_widget, self.locs_raster_plot, color_2, 'locs_density_image')]:
+                density_image = pg.ImageItem()
+                density_image.setLookupTable(pg.ColorMap([0, 1], [(255, 255, 255), color]).getLookupTable(nPts=256))
+                density_image.setZValue(-1)
+                raster_widget.addItem(density_image)
+                raster_plot.setVisible(False)
+                setattr(self, name, density_image)
+
         self.spike_locs_plot = self.spike_locs_widget.plot(
             pen=None, symbolPen=None, symbol="o", symbolBrush=color_2, symbolSize=4)
         self.spike_locs_widget.setLabels(
             title="Location of spikes in space", bottom="x (um)", left="y (um)")
 
         self.binned_spikes_plot = self.binned_spikes_widget.plot(
-            stepMode="left", fillLevel=0, fillOutline=True, brush=color_1)
+            stepMode="center", fillLevel=0, fillOutline=True, brush=color_1)
         self.binned_spikes_widget.setLabels(
-            title="Binned spike counts", bottom=f"Bin number. Bin width = ", left="counts")
+            title="Firing rate", bottom="time (s)", left="rate (Hz)")
 
         self.all_templates_plot = self.all_templates_widget.plot(
-            pen=pg.mkPen(color_3, width=2))
+            pen=pg.mkPen(color_3, width=2), connect="finite")
         self.all_templates_widget.setLabels(title="Unit templates")
 
+        self.neighbour_plots = []
+        for neighbour_widget in self.neighbour_widgets:
+            self.neighbour_plots.append(neighbour_widget.plot(
+                stepMode="center", fillLevel=0, fillOutline=True, brush=color_2))
+            neighbour_widget.setLabels(bottom="time (ms)", left="count")
+
+        # All channels' templates are drawn as one curve. Each row of these buffers is
+        # one channel, and the NaN in the final column breaks the curve between channels.
+        if self.have_extension["templates"]:
+            max_num_channels = self.data.sparsity_mask.sum(axis=1).max()
+            num_samples = self.data.all_templates.shape[1]
+            self.template_xs = np.full((max_num_channels, num_samples + 1), np.nan)
+            self.template_ys = np.full((max_num_channels, num_samples + 1), np.nan)
+
         self.update_plot(unit_data)
+        self.data.prefetch(self.good_unit_indices[self.id_1_tracker + 1:])
 
     def update_plot(self, unit_data):
 
+        profiler = self.profiler
+
         if self.have_extension["spike_amplitudes"]:
-            self.amps_raster_plot.setData(
-                unit_data['spikes']/self.fs, unit_data['amps'])
+            with profiler.time("update_plot/amplitudes"):
+                self.amps_raster_plot.setData(
+                    unit_data['spikes']/self.fs, unit_data['amps'])
+                if self.amps_density_image is not None:
+                    self.update_density_image(
+                        self.amps_density_image, unit_data['amp_density'], unit_data['amp_density_range'], unit_data['density_bins'])
         if self.have_extension["spike_locations"]:
-            self.locs_raster_plot.setData(
-                unit_data['spikes']/self.fs, unit_data['locs_y'])
-            self.spike_locs_plot.setData(
-                unit_data['locs_x'], unit_data['locs_y'])
+            with profiler.time("update_plot/locations"):
+                self.locs_raster_plot.setData(
+                    unit_data['spikes']/self.fs, unit_data['locs_y'])
+                if self.locs_density_image is not None:
+                    self.update_density_image(
+                        self.locs_density_image, unit_data['loc_density'], unit_data['loc_density_range'], unit_data['density_bins'])
+                self.spike_locs_plot.setData(
+                    unit_data['locs_x'], unit_data['locs_y'])
 
         if self.have_extension["templates"]:
-            self.max_templates_plot.setData(unit_data['template'])
-            self.all_templates_widget.clear()
-            self.update_template_plot(
-                unit_data['channel_locations'], unit_data['all_templates'])
-
-        self.binned_spikes_plot.setData(
-            unit_data['binned_spikes'])
-
-        self.correlogram_plot.setData(
-            unit_data['correlogram_bins'][1:], unit_data['correlograms'])
-        self.correlogram_zoom_plot.setData(
-            unit_data['wide_bins'][1:], unit_data['wide_correlograms'])
+            with profiler.time("update_plot/templates"):
+                self.max_templates_plot.setData(unit_data['template'])
+                self.update_template_plot(
+                    unit_data['channel_locations'], unit_data['all_templates'])
+
+        with profiler.time("update_plot/firing_rates"):
+            self.binned_spikes_plot.setData(
+                unit_data['firing_rate_bins'], unit_data['firing_rates'])
+
+        with profiler.time("update_plot/correlograms"):
+            self.correlogram_plot.setData(
+                unit_data['correlogram_bins'][1:], unit_data['correlograms'])
+            self.correlogram_zoom_plot.setData(
+                unit_data['wide_bins'][1:], unit_data['wide_correlograms'])
+
+        # the cross-correlograms are computed in the background, and plotted once they're ready
+        if self.num_neighbours > 0:
+            with profiler.time("update_plot/neighbour_correlograms"):
+                self.neighbour_correlograms_future = self.data.get_neighbour_correlograms(self.unit_index, self.num_neighbours)
+                self.neighbour_correlograms_future.add_done_callback(self.neighbour_correlograms_ready.emit)
 
         if self.have_extension["unit_locations"]:
-            self.unit_locations_plot_3.setData([unit_data['unit_location'][0]], [
-                unit_data['unit_location'][1]])
+            with profiler.time("update_plot/unit_location"):
+                self.unit_locations_plot_3.setData([unit_data['unit_location'][0]], [
+                    unit_data['unit_location'][1]])
 
         self.unit_locations_widget.setLabels(
             title=f"UNIT {self.unit_id} -- Unit location")
 
+    def update_neighbour_correlograms(self, future):
+
+        # the user has already moved on to another unit
+        if future is not self.neighbour_correlograms_future:
+            return
+
+        with self.profiler.time("neighbour_correlograms/plot"):
+            neighbours, correlograms, bins = future.result()
+            for neighbour_widget, neighbour_plot, neighbour, correlogram in zip(self.neighbour_widgets, self.neighbour_plots, neighbours, correlograms):
+                if neighbour < 0:
+                    neighbour_plot.setData([], [])
+                    neighbour_widget.setLabels(title="No more units nearby")
+                else:
+                    neighbour_plot.setData(bins, correlogram)
+                    neighbour_widget.setLabels(title=f"Cross-correlogram with unit {self.data.unit_ids[neighbour]}")
+
+    def update_density_image(self, density_image, density, value_range, density_bins):
+
+        # log scale, so that the sparse spikes are still visible next to the dense ones
+        density_image.setImage(np.log1p(density.astype(np.float32)), autoLevels=True)
+        density_image.setRect(QtCore.QRectF(
+            density_bins[0], value_range[0], density_bins[-1] - density_bins[0], value_range[1] - value_range[0]))
+
+    def update_raster_detail(self):
+        """In density mode, only show the sampled spikes when the rasters are zoomed in."""
+
+        if self.density_rasters is False:
+            return
+
+        duration = self.data.total_samples / self.fs
+        for raster_widget, raster_plot in [(self.amp_raster_widget, self.amps_raster_plot),
+                                           (self.loc_raster_widget, self.locs_raster_plot)]:
+            x_min, x_max = raster_widget.viewRange()[0]
+            raster_plot.setVisible(x_max - x_min < DENSITY_DETAIL_FRACTION * duration)
+
     def update_template_plot(self, channel_locations, all_templates):
 
-        template_channels_locs_1 = channel_locations[self.data.sparsity_mask[self.unit_id]]
+        template_channels_locs = channel_locations[self.data.sparsity_mask[self.unit_index]]
+        num_channels, num_samples = all_templates.shape
+
+        np.add(4*template_channels_locs[:, 0:1], np.arange(num_samples),
+               out=self.template_xs[:num_channels, :num_samples])
+        np.add(template_channels_locs[:, 1:2], all_templates,
+               out=self.template_ys[:num_channels, :num_samples])
 
-        for template_index, template_channel_loc in enumerate(template_channels_locs_1):
-            curve = pg.PlotCurveItem(4*template_channel_loc[0] + np.arange(
-                90), template_channel_loc[1]/1 + all_templates[template_index, :], pen=pg.mkPen(color_3, width=2))
-            self.all_templates_widget.addItem(curve)
+        self.all_templates_plot.setData(
+            self.template_xs[:num_channels].ravel(), self.template_ys[:num_channels].ravel(), connect="finite")
 
     # USER LOGIC
 
@@ -273,71 +626,156 @@ class MainWindow(QtWidgets.QMainWindow):
 
         keystroke = event.text()
 
+        if keystroke == "q":
+            self.close()
+            return
+
+        if keystroke == "\r":
+            self.next_session()
+            return
+
+        with self.profiler.time("unit_switch/total"):
+            with self.profiler.time("unit_switch/save_choice"):
+                self.save_choice(keystroke)
+            with self.profiler.time("unit_switch/apply_keystroke"):
+                self.apply_keystroke(keystroke)
+            self.unit_ids_updated()
+
+    def apply_keystroke(self, keystroke):
+        """Update the curation state after `keystroke` was pressed on the current unit."""
+
         if keystroke in self.first_letters:
             self.curated_ids.append(self.unit_id)
+            add_label(self.final_labels, self.labelled_units, self.unit_index, (self.decision_counter, keystroke))
             self.id_1_tracker += 1
+            if self.id_1_tracker == len(self.good_units):
+                if self.sessions is not None and self.sessions.has_next():
+                    print("That was the last unit! Press Enter to go to the next session, or q to save and quit.")
+                else:
+                    print("That was the last unit! Press q to save and quit.")
+                self.id_1_tracker -= 1
         elif keystroke == "u":
-            self.id_1_tracker -= 1
-            if self.id_1_tracker == -1:
+            # restore the latest unit's previous label, and go back to it
+            unit_index = undo_label(self.final_labels, self.labelled_units)
+            if unit_index is None:
                 print("Nothing to undo")
-                self.id_1_tracker = 0
-        elif keystroke == "q":
-            self.close()
+            else:
+                positions = np.flatnonzero(self.good_unit_indices == unit_index)
+                if len(positions) > 0:
+                    self.id_1_tracker = int(positions[0])
 
-        self.save_choice(keystroke)
+        self.decision_counter += 1
 
         self.unit_id = self.good_units[self.id_1_tracker]
-        self.unit_ids_updated()
+        self.unit_index = self.good_unit_indices[self.id_1_tracker]
 
     def unit_ids_updated(self):
 
-        unit_data = self.data.get_unit_data(self.unit_id)
-        self.update_plot(unit_data)
+        with self.profiler.time("unit_switch/get_unit_data"):
+            unit_data = self.data.get_unit_data(self.unit_index)
+        with self.profiler.time("unit_switch/update_plot"):
+            self.update_plot(unit_data)
+        with self.profiler.time("unit_switch/prefetch"):
+            self.data.prefetch(self.good_unit_indices[self.id_1_tracker + 1:])
 
     # SAVING STUFF
 
     def initialise_choice_df(self):
 
-        string_to_write = "index,keystroke,unit_id"
-        for key in self.data.metrics.keys():
-            string_to_write += f",{key}"
-        string_to_write += "\n"
-
         decision_data_cache_path = self.output_folder / \
             Path("decision_data_cache.csv")
-        if decision_data_cache_path.is_file():
-            decision_data_cache_path.unlink()
+        self.decision_journal = DecisionJournal(
+            decision_data_cache_path, self.data.metrics, len(self.data.unit_ids), resume=self.resume)
+
+        for unit_index in self.new_prelabels:
+            decision_index, keystroke = self.final_labels[unit_index]
+            self.decision_journal.log(decision_index, PRELABEL_PREFIX + keystroke, self.data.unit_ids[unit_index], unit_index)
+
+    def resume_session(self):
+        """Replay the decisions of a previous session, so that undo carries on from where it left off."""
+
+        self.final_labels, self.labelled_units, self.prelabelled_units, self.decision_counter = replay_journal(
+            self.output_folder / Path("decision_data_cache.csv"), self.data.unit_ids, self.first_letters)
+
+        print(f"Resuming with {len(self.final_labels)} units already labelled.")
+
+    def prelabel(self, prelabel_rules):
+        """Label the units which match the prelabel rules, and haven't already been labelled."""
+
+        if len(self.data.metrics.columns) == 0:
+            print("Can't prelabel without the quality_metrics or template_metrics extensions.")
+            return
+
+        prelabels = prelabel_units(self.data.metrics, prelabel_rules)
+        for unit_index in np.flatnonzero(prelabels != None):
+            if unit_index in self.final_labels:
+                continue
+            self.final_labels[unit_index] = (self.decision_counter, prelabels[unit_index])
+            self.prelabelled_units.add(unit_index)
+            self.new_prelabels.append(unit_index)
+            self.decision_counter += 1
+
+        if len(self.new_prelabels) == 0:
+            print("No new units matched the prelabel rules.")
+            return
+
+        import pandas as pd
+
+        prelabel_counts = pd.Series([self.final_labels[unit_index][1] for unit_index in self.new_prelabels], dtype=object).value_counts()
+        label_names = {label[0]: label for label in self.labels}
+        print(f"Prelabelled {len(self.new_prelabels)} units: " + ", ".join(f"{count} as {label_names[keystroke]}" for keystroke, count in prelabel_counts.items()))
+
+    def initialise_queue(self):
+        """Queue up the units which weren't prelabelled, and start at the first unlabelled one."""
+
+        self.good_unit_indices = np.array(
+            [unit_index for unit_index in self.unit_order if unit_index not in self.prelabelled_units], dtype=int)
+        checked_units = self.final_labels
+        if len(self.good_unit_indices) == 0:
+            print("Every unit was prelabelled. Showing them all, so you can check them.")
+            self.good_unit_indices = self.unit_order
+            # every unit has a prelabel, so start at the first one not yet checked in the GUI
+            checked_units = {unit_index for unit_index, _ in self.labelled_units}
+        self.good_units = self.data.unit_ids[self.good_unit_indices]
+
+        self.curated_ids = list(self.data.unit_ids[list(self.final_labels)])
+
+        self.id_1_tracker = len(self.good_units) - 1
+        for position, unit_index in enumerate(self.good_unit_indices):
+            if unit_index not in checked_units:
+                self.id_1_tracker = position
+                break
+        self.unit_id = self.good_units[self.id_1_tracker]
+        self.unit_index = self.good_unit_indices[self.id_1_tracker]
 
-        with open(decision_data_cache_path, 'w') as decision_file:
-            decision_file.write(string_to_write)
+        if len(self.prelabelled_units) > 0:
+            print(f"{len(self.good_units)} units to curate.")
 
     def save_choice(self, keystroke):
 
-        string_to_write = f"{self.decision_counter},{keystroke},{self.unit_id}"
-        for values in self.data.metrics.iloc[self.unit_id].values:
-            string_to_write += f",{values}"
-        string_to_write += "\n"
-
-        with open(self.output_folder / Path("decision_data_cache.csv"), 'a') as decision_file:
-            decision_file.write(string_to_write)
-
-        self.decision_counter += 1
+        try:
+            self.decision_journal.log(self.decision_counter, keystroke, self.unit_id, self.unit_index)
+        except RuntimeError as error:
+            print(f"Warning: {error}. Decisions are no longer being saved as you go, but the labels will still be saved when you quit.")
 
     def save_labels(self):
 
-        curated_ids = np.unique(self.curated_ids)
-        save_choice_df = pd.read_csv(
-            self.output_folder / Path("decision_data_cache.csv"))
+        import pandas as pd
 
-        final_choices_list = []
-        for unit_id in curated_ids:
-            final_choices_list.append(save_choice_df.query(
-                f'unit_id == {unit_id}').iloc[-1])
+        # the latest label of each unit is kept up to date in `final_labels`, so we
+        # don't need to look back through the decisions
+        labelled_unit_indices = np.array(sorted(self.final_labels), dtype=int)
+        decision_indices = [self.final_labels[unit_index][0] for unit_index in labelled_unit_indices]
+        labels = [self.final_labels[unit_index][1] for unit_index in labelled_unit_indices]
 
-        keys = save_choice_df.keys()
-        final_choices_df = pd.DataFrame(final_choices_list, columns=keys)
-        final_choices_df = final_choices_df.rename(
-            columns={'keystroke': 'label'})
+        final_choices_df = pd.DataFrame({
+            'index': decision_indices,
+            'label': labels,
+            'unit_id': self.data.unit_ids[labelled_unit_indices],
+        })
+        metrics_df = pd.DataFrame(
+            self.decision_journal.metrics_values[labelled_unit_indices], columns=self.decision_journal.metric_names)
+        final_choices_df = pd.concat([final_choices_df, metrics_df], axis=1)
 
         final_choices_df.to_csv(
             self.output_folder / Path("decision_data_with_metics.csv"), index=False)
@@ -345,9 +783,17 @@ class MainWindow(QtWidgets.QMainWindow):
         just_labels.to_csv(self.output_folder /
                            Path("just_labels.csv"), index=False)
 
+        if self.save_parquet:
+            try:
+                final_choices_df.to_parquet(
+                    self.output_folder / Path("decision_data_with_metics.parquet"), index=False)
+            except ImportError:
+                print("Saving to parquet needs `pyarrow` or `fastparquet`. Only saved the csv files.")
+
     def closeEvent(self, event):
-        print("Saving final curation...")
-        self.save_labels()
+        self.finish_session()
+        if self.sessions is not None:
+            self.sessions.shutdown()
         event.accept()  # let the window close
 
 
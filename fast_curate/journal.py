@@ -0,0 +1,203 @@
+"""
+    Writing the curation decisions to disk, without slowing down the GUI
+"""
+import os
+import time
+import queue
+import threading
+
+import numpy as np
+
+from prelabel import PRELABEL_PREFIX
+
+
+class DecisionJournal:
+    """
+    An append-only csv log of every keystroke, with the unit's metrics. The file is kept open
+    and written to by a background thread, so logging a decision costs the GUI thread
+    almost nothing. Each batch of decisions is flushed as soon as it is written, so the
+    log survives the GUI being killed, and the file is fsync-ed every `fsync_interval`
+    seconds, so it also survives the computer crashing. If writing fails, the error is
+    raised by the next `log` or `close`, as a RuntimeError.
+    """
+
+    def __init__(self, journal_path, metrics, num_units, resume=False, fsync_interval=5):
+
+        self.journal_path = journal_path
+        self.fsync_interval = fsync_interval
+
+        self.metric_names = list(metrics.keys())
+        if len(metrics) == 0:
+            self.metrics_values = np.zeros((num_units, 0))
+        else:
+            self.metrics_values = metrics.to_numpy(dtype='float')
+
+        self.decision_queue = queue.Queue()
+        # set by the writer thread if writing fails, which stops it
+        self.error = None
+
+        header = ",".join(["index", "keystroke", "unit_id"] + self.metric_names) + "\n"
+        if resume:
+            with open(journal_path, 'rb+') as journal_file:
+                previous_header = journal_file.readline().decode()
+                # If the last session was killed mid-write, drop the incomplete last line
+                journal_file.seek(0, os.SEEK_END)
+                journal_size = journal_file.tell()
+                journal_file.seek(max(journal_size - 4096, 0))
+                journal_tail = journal_file.read()
+                if journal_tail.endswith(b"\n") is False and b"\n" in journal_tail:
+                    journal_file.truncate(journal_size - len(journal_tail) + journal_tail.rindex(b"\n") + 1)
+            if previous_header != header:
+                print("Warning: the metrics have changed since the previous session. New rows of `decision_data_cache.csv` will have different columns to the old rows.")
+
+            self.journal_file = open(journal_path, 'a')
+        else:
+            self.journal_file = open(journal_path, 'w')
+            self.journal_file.write(header)
+        self.journal_file.flush()
+
+        self.writer_thread = threading.Thread(target=self.write_decisions, daemon=True)
+        self.writer_thread.start()
+
+    def log(self, decision_index, keystroke, unit_id, unit_index):
+        """Queue a decision to be written. Called from the GUI thread."""
+
+        self.check_error()
+        self.decision_queue.put((decision_index, keystroke, unit_id, unit_index))
+
+    def close(self):
+        """Write any queued decisions, then sync and close the file."""
+
+        self.decision_queue.put(None)
+        self.writer_thread.join()
+        self.check_error()
+
+    def check_error(self):
+
+        if self.error is not None:
+            raise RuntimeError(f"Could not write the decisions to {self.journal_path}: {self.error}") from self.error
+
+    def write_decisions(self):
+
+        # keep any error for the GUI thread, rather than losing it with this thread
+        try:
+            self.write_until_closed()
+            self.journal_file.close()
+        except Exception as error:
+            self.error = error
+            try:
+                self.journal_file.close()
+            except OSError:
+                pass
+
+    def write_until_closed(self):
+
+        last_fsync = time.monotonic()
+        unsynced = False
+        closing = False
+
+        while closing is False:
+            # Wait for a decision, but wake up now and again to fsync
+            try:
+                decisions = [self.decision_queue.get(timeout=self.fsync_interval)]
+            except queue.Empty:
+                decisions = []
+            # write everything that is queued in one go
+            while self.decision_queue.empty() is False:
+                decisions.append(self.decision_queue.get())
+
+            if None in decisions:
+                closing = True
+                decisions.remove(None)
+
+            if len(decisions) > 0:
+                lines = []
+                for decision_index, keystroke, unit_id, unit_index in decisions:
+                    metric_values = self.metrics_values[unit_index].tolist()
+                    lines.append(",".join(map(str, [decision_index, keystroke, unit_id] + metric_values)) + "\n")
+                self.journal_file.writelines(lines)
+                self.journal_file.flush()
+                unsynced = True
+
+            if unsynced and (closing or time.monotonic() - last_fsync > self.fsync_interval):
+                os.fsync(self.journal_file.fileno())
+                last_fsync = time.monotonic()
+                unsynced = False
+
+
+def read_journal(journal_path):
+    """
+    Stream the (decision index, keystroke, unit id) of each decision in a journal. The
+    metrics are not parsed, and incomplete lines (e.g. from a crash) are skipped.
+    """
+
+    with open(journal_path, 'r') as journal_file:
+        next(journal_file)
+        for line in journal_file:
+            if line.endswith("\n") is False:
+                continue
+            fields = line.rstrip("\n").split(",", 3)
+            if len(fields) < 3 or fields[0].isdigit() is False:
+                continue
+            yield int(fields[0]), fields[1], fields[2]
+
+
+def add_label(final_labels, labelled_units, unit_index, label):
+    """
+    Give a unit its `label`, a (decision index, keystroke), and push the unit and its
+    previous label (or None) onto the `labelled_units` stack, so that it can be undone.
+    """
+
+    labelled_units.append((unit_index, final_labels.get(unit_index)))
+    final_labels[unit_index] = label
+
+
+def undo_label(final_labels, labelled_units):
+    """
+    Undo the latest label on the `labelled_units` stack, which gives its unit back the
+    label it had before, if any (e.g. a prelabel). Returns the unit's index, or None if
+    there is nothing to undo. The GUI and `replay_journal` both label and undo with these
+    functions, so a resumed session always ends up with the same labels.
+    """
+
+    if len(labelled_units) == 0:
+        return None
+    unit_index, previous_label = labelled_units.pop()
+    if previous_label is None:
+        final_labels.pop(unit_index, None)
+    else:
+        final_labels[unit_index] = previous_label
+
+    return unit_index
+
+
+def replay_journal(journal_path, unit_ids, first_letters):
+    """
+    Replay the decisions in a journal. Labels push units onto a stack, and each undo pops
+    the latest unit and gives it back its previous label. Prelabels can't be undone, so
+    aren't put on the stack. Decisions about units which aren't in `unit_ids` are skipped.
+
+    Returns the `final_labels` (unit index: (decision index, keystroke)), the stack of
+    `labelled_units`, the set of prelabelled units and the next decision index.
+    """
+
+    unit_id_to_index = {str(unit_id): unit_index for unit_index, unit_id in enumerate(unit_ids)}
+    final_labels = {}
+    labelled_units = []
+    prelabelled_units = set()
+    decision_counter = 0
+
+    for decision_index, keystroke, unit_id in read_journal(journal_path):
+        decision_counter = decision_index + 1
+        unit_index = unit_id_to_index.get(unit_id)
+        if unit_index is None:
+            continue
+        if keystroke in first_letters:
+            add_label(final_labels, labelled_units, unit_index, (decision_index, keystroke))
+        elif keystroke.startswith(PRELABEL_PREFIX) and keystroke[len(PRELABEL_PREFIX):] in first_letters:
+            final_labels[unit_index] = (decision_index, keystroke[len(PRELABEL_PREFIX):])
+            prelabelled_units.add(unit_index)
+        elif keystroke == "u":
+            undo_label(final_labels, labelled_units)
+
+    return final_labels, labelled_units, prelabelled_units, decision_counter
@@ -0,0 +1,63 @@
+"""
+    Labelling the obvious units automatically, from their metrics, before the GUI opens
+"""
+import json
+
+import numpy as np
+
+# Prelabels are saved in the decision log with this in front of the keystroke, so they
+# can be told apart from the keystrokes pressed in the GUI
+PRELABEL_PREFIX = "auto:"
+
+
+def load_prelabel_rules(rules_path, labels):
+    """
+    Read the prelabelling rules from a json file, which maps each label to a rule, or a
+    list of rules, written as a pandas query on the metrics. For example:
+
+        {
+            "noise": ["snr < 2", "firing_rate < 0.05"],
+            "sua": "snr > 5 and isi_violations_ratio < 0.1 and presence_ratio > 0.9"
+        }
+
+    A unit gets a label if any of the label's rules are true. Returns a dict from the
+    first letter of each label (its keystroke) to its list of rules.
+    """
+
+    with open(rules_path, 'r') as rules_file:
+        label_rules = json.load(rules_file)
+
+    rules = {}
+    for label, label_rule in label_rules.items():
+        assert label in labels, f"The prelabel rules contain the label '{label}', which isn't one of your labels {labels}."
+        if isinstance(label_rule, str):
+            label_rule = [label_rule]
+        rules[label[0]] = list(label_rule)
+
+    return rules
+
+
+def prelabel_units(metrics, rules):
+    """
+    Evaluate the `rules` on every unit's `metrics` at once. Returns the keystroke of each
+    unit's prelabel, or None if the unit doesn't match any label or matches more than one.
+    """
+
+    num_units = len(metrics)
+    matches = {}
+    for keystroke, label_rules in rules.items():
+        matches[keystroke] = np.zeros(num_units, dtype=bool)
+        for rule in label_rules:
+            try:
+                # NaN metrics never pass a comparison, so don't match the rule
+                matches[keystroke] |= metrics.eval(rule).to_numpy(dtype=bool)
+            except Exception as error:
+                raise ValueError(f"Could not evaluate the prelabel rule '{rule}' on the metrics: {error}") from error
+
+    prelabels = np.full(num_units, None, dtype=object)
+    if len(rules) > 0:
+        num_matches = np.sum(list(matches.values()), axis=0)
+        for keystroke, label_matches in matches.items():
+            prelabels[label_matches & (num_matches == 1)] = keystroke
+
+    return prelabels
@@ -0,0 +1,107 @@
+"""
+    Optional timing of the wrangling and of each unit switch, to see where the time goes
+"""
+import json
+import time
+import threading
+from pathlib import Path
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+PERCENTILES = [50, 90, 99]
+
+
+class Profiler:
+    """
+    Records how long each named stage takes, every time it runs. Stages are named
+    "<group>/<stage>", e.g. "wrangle/templates" or "unit_switch/update_plot". If `enabled`
+    is False, nothing is recorded and timing a stage costs almost nothing, so the
+    profiler can be left in place.
+    """
+
+    def __init__(self, enabled=False):
+
+        self.enabled = enabled
+        self.stage_times = {}
+        self.info = {}
+        # stages are timed from the wrangling and prefetching threads too
+        self.lock = threading.Lock()
+
+    def time(self, stage):
+        """Context manager which times the code inside it as one run of `stage`."""
+
+        if self.enabled is False:
+            return nullcontext()
+        return self._time(stage)
+
+    @contextmanager
+    def _time(self, stage):
+
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start_time)
+
+    def record(self, stage, seconds):
+
+        if self.enabled is False:
+            return
+        with self.lock:
+            self.stage_times.setdefault(stage, []).append(seconds)
+
+    def reset(self):
+
+        with self.lock:
+            self.stage_times = {}
+
+    def summary(self):
+        """A DataFrame with one row per stage, from `stage_summaries`."""
+
+        import pandas as pd
+
+        columns = ['stage', 'count', 'total_ms', 'mean_ms'] + [f'p{percentile}_ms' for percentile in PERCENTILES] + ['max_ms']
+        return pd.DataFrame(self.stage_summaries(), columns=columns)
+
+    def stage_summaries(self):
+        """The number of runs of each stage, and the total, mean, percentile and max times in ms."""
+
+        rows = []
+        with self.lock:
+            stage_times = {stage: np.array(times) * 1e3 for stage, times in self.stage_times.items()}
+
+        for stage, times in stage_times.items():
+            row = {
+                'stage': stage,
+                'count': int(times.size),
+                'total_ms': float(times.sum()),
+                'mean_ms': float(times.mean()),
+            }
+            for percentile, value in zip(PERCENTILES, np.percentile(times, PERCENTILES)):
+                row[f'p{percentile}_ms'] = float(value)
+            row['max_ms'] = float(times.max())
+            rows.append(row)
+
+        return rows
+
+    def report(self):
+        """The `info` about the session, and the summary of each stage keyed by its name."""
+
+        return {
+            'info': self.info,
+            'stages': {row.pop('stage'): row for row in self.stage_summaries()},
+        }
+
+    def save(self, output_folder):
+        """Write the summary to `profile.csv` and, with `info` about the session, to `profile.json`."""
+
+        if self.enabled is False:
+            return
+
+        self.summary().to_csv(Path(output_folder) / Path("profile.csv"), index=False)
+
+        with open(Path(output_folder) / Path("profile.json"), 'w') as report_file:
+            json.dump(self.report(), report_file, indent=4, default=str)
+
+        print(f"Saved timing report to {Path(output_folder) / Path('profile.json')}")
@@ -0,0 +1,95 @@
+"""
+    Curating many sessions, one after the other, in one window
+"""
+import json
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from batch import make_bundle
+
+
+def load_manifest(manifest_path):
+    """
+    Read a json list of sessions, each with an `output_folder` and either an
+    `analyzer_path` or a `bundle_path`. For example:
+
+        [
+            {"analyzer_path": "M25/D20/kilosort4_sa", "output_folder": "M25/D20/curation"},
+            {"bundle_path": "bundles/M25_D21.npz", "output_folder": "M25/D21/curation"}
+        ]
+
+    Relative paths are relative to the folder of the manifest.
+    """
+
+    manifest_path = Path(manifest_path)
+    with open(manifest_path, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+
+    sessions = []
+    for session in manifest:
+        assert 'output_folder' in session, f"Every session in the manifest needs an `output_folder`: {session}"
+        assert ('analyzer_path' in session) != ('bundle_path' in session), \
+            f"Every session in the manifest needs either an `analyzer_path` or a `bundle_path`: {session}"
+        sessions.append({key: manifest_path.parent / Path(path) for key, path in session.items()})
+
+    return sessions
+
+
+class SessionQueue:
+    """
+    The sessions still to be curated. The next session is wrangled into a curation bundle
+    in a background process while the current one is curated, so it opens instantly. A
+    process, rather than a thread, keeps the GUI responsive and lets numba run in parallel.
+    """
+
+    def __init__(self, sessions, no_cache=False, full_correlograms=False, firing_rate_bin_s=None, density_rasters=False):
+
+        self.sessions = list(sessions)
+        self.no_cache = no_cache
+        self.full_correlograms = full_correlograms
+        self.firing_rate_bin_s = firing_rate_bin_s
+        self.density_rasters = density_rasters
+
+        self.next_bundle = None
+        # spawn, rather than fork, as forking a process running Qt isn't safe
+        self.executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+        self.prepare_next()
+
+    def has_next(self):
+
+        return len(self.sessions) > 0
+
+    def prepare_next(self):
+        """Start making the bundle of the next session, if it comes from an analyzer."""
+
+        self.next_bundle = None
+        if self.has_next() and 'analyzer_path' in self.sessions[0]:
+            session = self.sessions[0]
+            cache_folder = None
+            if self.no_cache is False:
+                cache_folder = session['output_folder'] / Path("cache")
+            session['output_folder'].mkdir(parents=True, exist_ok=True)
+            self.next_bundle = self.executor.submit(
+                make_bundle, session['analyzer_path'], session['output_folder'] / Path("curation_bundle.npz"),
+                cache_folder, self.full_correlograms, self.firing_rate_bin_s, self.density_rasters)
+
+    def next(self):
+        """Wait for the next session to be ready, and return its data and output folder."""
+
+        from wrangle import DataForGUI
+
+        session = self.sessions.pop(0)
+        if self.next_bundle is not None:
+            bundle_path = self.next_bundle.result()
+        else:
+            bundle_path = session['bundle_path']
+        data = DataForGUI.from_bundle(bundle_path)
+
+        self.prepare_next()
+
+        return data, session['output_folder']
+
+    def shutdown(self):
+
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,68 +1,89 @@
 """
     Wrangling the data needed to construct the GUI
 """
+import json
+import time
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
 import numpy as np
 from copy import deepcopy
 import pandas as pd
 
-import spikeinterface.full as si
-from compute import compute_autocorrelograms
+from compute import compute_all_autocorrelograms, compute_streamed_autocorrelograms, compute_firing_rates, compute_spike_densities, get_value_ranges, compute_template_similarity, order_by_similarity, compute_cross_correlograms, get_neighbour_units, get_spike_times, separate_segments
+from cache import AnalyzerCache
+from profiling import Profiler
+
+# Bump this whenever the content of a curation bundle changes
+BUNDLE_VERSION = 2
+
+# The arrays which hold all the data needed by the GUI, saved in curation bundles
+BUNDLE_ARRAYS = [
+    'unit_ids', 'sparsity_mask', 'channel_locations', 'unit_locations', 'unit_spike_offsets', 'spikes',
+    'amps', 'locs_x', 'locs_y', 'templates', 'all_templates', 'template_channel_offsets',
+    'correlograms', 'correlogram_bins', 'wide_correlograms', 'wide_bins', 'firing_rates', 'firing_rate_bins',
+    'amp_densities', 'amp_density_ranges', 'loc_densities', 'loc_density_ranges', 'density_bins',
+]
+
+# The size of each unit's (time, value) images of its spikes' amplitudes and depths
+DENSITY_TIME_BINS = 200
+DENSITY_VALUE_BINS = 40
+
+# The (window_ms, bin_ms) of the cross-correlograms between neighbouring units
+CROSS_CORRELOGRAM_WINDOW_BIN_MS = (50, 2)
 
 class DataForGUI:
 
-    def __init__(self, sorting_analyzer, have_extension):
+    def __init__(self, sorting_analyzer, have_extension, cache_folder=None, seed=0, max_spikes_per_unit=3000, lazy=False, num_prefetch=5, num_keep=5, full_correlograms=False, firing_rate_bin_s=None, density_rasters=False, profiler=None):
 
         print("Wrangling, caching and computing with data...")
 
+        self.profiler = profiler if profiler is not None else Profiler()
+        with self.profiler.time("wrangle/total"):
+            self.wrangle(sorting_analyzer, have_extension, cache_folder=cache_folder, seed=seed, max_spikes_per_unit=max_spikes_per_unit,
+                         lazy=lazy, num_prefetch=num_prefetch, num_keep=num_keep, full_correlograms=full_correlograms,
+                         firing_rate_bin_s=firing_rate_bin_s, density_rasters=density_rasters)
+
+    def wrangle(self, sorting_analyzer, have_extension, cache_folder, seed, max_spikes_per_unit, lazy, num_prefetch, num_keep, full_correlograms, firing_rate_bin_s, density_rasters):
+
         self.merged_units = []
+        self.neighbour_correlograms = None
         self.sorting_analyzer = sorting_analyzer
+        self.have_extension = have_extension
+        self.seed = seed
+        self.max_spikes_per_unit = max_spikes_per_unit
+        self.lazy = lazy
+        # compute the autocorrelograms from every spike, rather than just the random spikes
+        self.full_correlograms = full_correlograms
 
         self.unit_ids = deepcopy(sorting_analyzer.unit_ids)
 
-        self.total_samples = sorting_analyzer.get_num_samples()
+        self.sampling_frequency = sorting_analyzer.sampling_frequency
 
-        ###############   Get data from sorting analyzer ###############
+        # Spike times are in samples, with the segments placed one after the other
+        segment_num_samples = [sorting_analyzer.get_num_samples(segment_index) for segment_index in range(sorting_analyzer.get_num_segments())]
+        self.segment_num_samples = segment_num_samples
+        self.total_samples = sum(segment_num_samples)
 
-        random_spike_indices = si.random_spikes_selection(sorting_analyzer.sorting, max_spikes_per_unit=3000)
-        spike_vector = sorting_analyzer.sorting.to_spike_vector()
-        random_spikes = spike_vector[random_spike_indices]
-        self.spikes = si.spike_vector_to_spike_trains([random_spikes], unit_ids = sorting_analyzer.unit_ids)[0]
+        # By default, split the recording into 20 bins
+        if firing_rate_bin_s is None:
+            firing_rate_bin_size = max(int(np.ceil(sum(segment_num_samples) / 20)), 1)
+        else:
+            firing_rate_bin_size = max(int(round(firing_rate_bin_s * sorting_analyzer.sampling_frequency)), 1)
 
-        self.amps = {}
-        self.locs_x = {}
-        self.locs_y = {}
-        
-        if have_extension['spike_amplitudes']:
-            amps = sorting_analyzer.get_extension("spike_amplitudes").get_data()
-            random_amps = amps[random_spike_indices]
-
-            for unit_id in sorting_analyzer.unit_ids:
-                self.amps[unit_id] = []
-            
-            for spike, amp in zip(random_spikes, random_amps):
-                unit_id = spike['unit_index']
-                self.amps[unit_id].append(amp)
-        amps = None
-        
-        if have_extension['spike_locations']:
-            locs_y = sorting_analyzer.get_extension("spike_locations").get_data()['y']
-            locs_x = sorting_analyzer.get_extension("spike_locations").get_data()['x']
-            random_locs_x = locs_x[random_spike_indices]
-            random_locs_y = locs_y[random_spike_indices]
-            
-            for unit_id in sorting_analyzer.unit_ids:
-                self.locs_x[unit_id] = []
-                self.locs_y[unit_id] = []
-
-            for spike, loc_x, loc_y in zip(random_spikes, random_locs_x, random_locs_y):
-                unit_id = spike['unit_index']
-                self.locs_x[unit_id].append(loc_x)
-                self.locs_y[unit_id].append(loc_y)
-        locs = None
-        
-        self.sparsity_mask = sorting_analyzer.sparsity.mask
+        # Each part is reloaded from the cache if nothing it depends on has changed
+        self.cache = AnalyzerCache(sorting_analyzer, cache_folder, seed)
+
+        ###############   Get data from sorting analyzer ###############
+
+        if sorting_analyzer.sparsity is not None:
+            self.sparsity_mask = sorting_analyzer.sparsity.mask
+        else:
+            self.sparsity_mask = np.ones((len(self.unit_ids), sorting_analyzer.get_num_channels()), dtype=bool)
         self.channel_locations = sorting_analyzer.get_channel_locations()
-        
+
         self.unit_xmin = min(self.channel_locations[:, 0])
         self.unit_xmax = max(self.channel_locations[:, 0])
         self.unit_ymin = min(self.channel_locations[:, 1])
@@ -71,84 +92,767 @@ class DataForGUI:
         if have_extension["unit_locations"]:
             self.unit_locations = sorting_analyzer.get_extension(
                 "unit_locations").get_data()[:, 0:2]
-        
-        
-        if have_extension['templates']:
-            max_channels = sorting_analyzer.channel_ids_to_indices(
-                si.get_template_extremum_channel(sorting_analyzer).values()
-            )
-            templates_data = sorting_analyzer.get_extension("templates").get_data()
-            self.templates = {unit_id_1:
-                          templates_data[unit_id_1, :, max_channels[sorting_analyzer.sorting.id_to_index(
-                              unit_id_1)]]
-                          for unit_id_1 in sorting_analyzer.unit_ids}
-            self.all_templates = {unit_id_1:
-                              templates_data[unit_id_1, :, self.sparsity_mask[sorting_analyzer.sorting.id_to_index(
-                                  unit_id_1)]]
-                              for unit_id_1 in sorting_analyzer.unit_ids}
-        else:
-            self.templates = {}
-            self.all_templates = {}
+
+        # The parts are independent, apart from needing the random spikes, so are computed
+        # (or loaded from the cache) in parallel. Most of the work is file reading,
+        # decompression and numba, which all release the GIL.
+        with ThreadPoolExecutor(max_workers=4) as executor:
+
+            random_spikes_future = executor.submit(
+                self.get_part, "random_spikes", [], self.compute_random_spikes, max_spikes_per_unit=max_spikes_per_unit)
+            if have_extension['templates']:
+                templates_future = executor.submit(
+                    self.get_part, "templates", ['templates'], self.compute_templates)
+            firing_rates_future = executor.submit(
+                self.get_part, "firing_rates", [], lambda: self.compute_firing_rates(segment_num_samples, firing_rate_bin_size),
+                firing_rate_bin_size=firing_rate_bin_size)
+            metrics_future = executor.submit(
+                self.get_part, "metrics", ['quality_metrics', 'template_metrics'], self.compute_metrics)
+
+            random_spikes_data = random_spikes_future.result()
+            random_spike_indices = random_spikes_data['random_spike_indices']
+            random_spikes = random_spikes_data['random_spikes']
+
+            # Group the random spikes by unit with a single stable sort. Each unit's spikes are
+            # then a contiguous, time-ordered slice, given by `unit_spike_offsets`, of `spikes`
+            # and of the per-spike arrays (amplitudes, locations) built from `unit_order`.
+            unit_order = np.argsort(random_spikes['unit_index'], kind='stable')
+            self.unit_spike_offsets = np.zeros(len(self.unit_ids) + 1, dtype=np.int64)
+            self.unit_spike_offsets[1:] = np.cumsum(np.bincount(
+                random_spikes['unit_index'], minlength=len(self.unit_ids)))
+            self.unit_spike_indices = random_spike_indices[unit_order]
+            self.spikes = get_spike_times(random_spikes, segment_num_samples)[unit_order]
+
+            # Images of the amplitudes and depths of every spike, rather than just the random
+            # spikes, against time. These only need the random spikes to set their ranges.
+            if density_rasters and (have_extension['spike_amplitudes'] or have_extension['spike_locations']):
+                densities_future = executor.submit(
+                    self.get_part, "spike_densities", ['spike_amplitudes', 'spike_locations'],
+                    lambda: self.compute_spike_densities(random_spike_indices, random_spikes, segment_num_samples),
+                    max_spikes_per_unit=max_spikes_per_unit, num_time_bins=DENSITY_TIME_BINS, num_value_bins=DENSITY_VALUE_BINS)
+
+            # The autocorrelograms of all units are computed in a single pass. If the
+            # correlograms extension exists, we only need to compute the wide ones.
+            window_bin_ms = [(500, 5)]
+            if have_extension["correlograms"] is False:
+                window_bin_ms.append((50, 2))
+
+            if lazy:
+                self.setup_lazy_units(window_bin_ms, num_prefetch, num_keep)
+            else:
+                self.wrangle_all_units(random_spike_indices, random_spikes, unit_order, window_bin_ms, executor)
+
+            # `templates` holds each unit's template on its max channel. The sparse templates
+            # of all units are packed into `all_templates`, one row per (unit, sparse channel),
+            # and unit i's rows are all_templates[template_channel_offsets[i]:template_channel_offsets[i+1]]
+            self.templates = None
+            self.all_templates = None
+            if have_extension['templates']:
+                templates_part = templates_future.result()
+                self.templates = templates_part['templates']
+                self.all_templates = templates_part['all_templates']
+                self.template_channel_offsets = templates_part['template_channel_offsets']
+
+            # the firing rate of every unit, in Hz, in time bins aligned to the recording
+            firing_rates_part = firing_rates_future.result()
+            self.firing_rates = firing_rates_part['firing_rates']
+            self.firing_rate_bins = firing_rates_part['firing_rate_bins']
+
+            metrics_part = metrics_future.result()
+            self.metrics = pd.DataFrame(
+                metrics_part['values'], index=metrics_part['index'], columns=metrics_part['columns'])
+
+            # unit i's images are amp_densities[i] and loc_densities[i], with time bins
+            # `density_bins` (in s) and value bins spanning amp_density_ranges[i] and loc_density_ranges[i]
+            densities_part = {}
+            if density_rasters and (have_extension['spike_amplitudes'] or have_extension['spike_locations']):
+                densities_part = densities_future.result()
+            for name in ['amp_densities', 'amp_density_ranges', 'loc_densities', 'loc_density_ranges', 'density_bins']:
+                setattr(self, name, densities_part.get(name))
+
+    def get_part(self, part, extensions, compute_function, **params):
+        """Get a part from the cache (or compute it), timing how long it took."""
+
+        with self.profiler.time(f"wrangle/{part}"):
+            return self.cache.get(part, extensions, compute_function, **params)
+
+    ###############   Order the units ###############
+
+    def get_unit_order(self, order="index"):
+        """
+        The order, as unit indices, to curate the units in:
+            "index": the order of the sorting
+            "depth": by depth along the probe, using the unit locations
+            "similarity": similar units are next to each other, starting from the deepest unit
+        """
+
+        if order == "index":
+            return np.arange(len(self.unit_ids))
+
+        depths = self.get_unit_depths()
+        if order == "depth":
+            if depths is None:
+                print("Can't order by depth without the unit_locations or templates extensions. Using the sorting's order.")
+                return np.arange(len(self.unit_ids))
+            return np.argsort(depths, kind='stable')
+
+        if order == "similarity":
+            similarity = self.get_template_similarity()
+            if similarity is None:
+                print("Can't order by similarity without the template_similarity or templates extensions. Using the sorting's order.")
+                return np.arange(len(self.unit_ids))
+            first_unit_index = 0 if depths is None else int(np.argmin(depths))
+            return order_by_similarity(similarity, first_unit_index)
+
+        raise ValueError(f"Unknown unit order '{order}'. Choose from 'index', 'depth' or 'similarity'.")
+
+    def get_unit_depths(self):
+
+        # a bundle has no analyzer, so its depths were worked out when it was made
+        if self.sorting_analyzer is None:
+            return self.unit_depths
+
+        if self.have_extension["unit_locations"]:
+            return self.unit_locations[:, 1]
+        if self.have_extension["templates"]:
+            from spikeinterface.core import get_template_extremum_channel
+
+            # the location of each unit's max channel
+            max_channels = self.sorting_analyzer.channel_ids_to_indices(
+                list(get_template_extremum_channel(self.sorting_analyzer).values()))
+            return self.channel_locations[max_channels, 1]
+        return None
+
+    def get_template_similarity(self):
+        """The similarity of every pair of units, from the template_similarity extension if it exists."""
+
+        if self.sorting_analyzer is None:
+            return self.template_similarity
+
+        if self.have_extension.get("template_similarity", False):
+            return self.sorting_analyzer.get_extension("template_similarity").get_data()
+        if self.have_extension["templates"] is False:
+            return None
+        return self.get_part("template_similarity", ['templates'], self.compute_template_similarity)['similarity']
+
+    def compute_template_similarity(self):
+
+        templates_data = self.sorting_analyzer.get_extension("templates").get_data()
+        return {'similarity': compute_template_similarity(templates_data, self.sparsity_mask)}
+
+    ###############   Cross-correlograms of neighbouring units ###############
+
+    def get_neighbour_correlograms(self, unit_index, num_neighbours):
+        """
+        Start computing the cross-correlograms between `unit_index` and its `num_neighbours`
+        nearest units in the background. Returns a Future of the neighbours' unit indices
+        (-1 where there are fewer neighbours), their correlograms and the bins in ms.
+        """
+
+        if self.neighbour_correlograms is None:
+            unit_locations = self.unit_locations if self.have_extension["unit_locations"] else None
+            self.neighbour_units = get_neighbour_units(self.sparsity_mask, unit_locations, num_neighbours)
+            self.neighbour_correlograms = PairCorrelogramCache(self.compute_pair_correlograms)
+
+        neighbours = self.neighbour_units[unit_index]
+        return self.neighbour_correlograms.get(unit_index, neighbours)
+
+    def compute_pair_correlograms(self, pairs):
+        """The cross-correlograms of the random spikes of each of `pairs` of units."""
+
+        window_ms, bin_ms = CROSS_CORRELOGRAM_WINDOW_BIN_MS
+        with self.profiler.time("unit_data/cross_correlograms"):
+            # this runs in a background thread, so numba can't run in parallel
+            return compute_cross_correlograms(
+                self.get_correlogram_spikes(self.spikes), self.unit_spike_offsets, pairs, self.sampling_frequency, window_ms, bin_ms, parallel=False)
+
+    ###############   Curation bundles ###############
+
+    def save_bundle(self, bundle_path):
+        """
+        Save everything the GUI needs into a single compressed file, which can be opened
+        with `from_bundle` without spikeinterface or the analyzer.
+        """
+
+        assert self.lazy is False, "Can only save a curation bundle from data wrangled with `lazy=False`."
+
+        bundle = {}
+        for name in BUNDLE_ARRAYS:
+            value = getattr(self, name, None)
+            if value is not None:
+                bundle[name] = np.asarray(value)
+        bundle['metrics_values'] = self.metrics.to_numpy(dtype='float')
+        bundle['metrics_index'] = np.array(self.metrics.index.tolist())
+        bundle['metrics_columns'] = np.array(self.metrics.columns.tolist(), dtype='str')
+
+        unit_depths = self.get_unit_depths()
+        if unit_depths is not None:
+            bundle['unit_depths'] = unit_depths
+        template_similarity = self.get_template_similarity()
+        if template_similarity is not None:
+            bundle['template_similarity'] = template_similarity.astype(np.float32)
+
+        metadata = {
+            'version': BUNDLE_VERSION,
+            'analyzer_folder': str(Path(self.sorting_analyzer.folder).resolve()) if self.sorting_analyzer.folder is not None else None,
+            'have_extension': self.have_extension,
+            'sampling_frequency': self.sampling_frequency,
+            'total_samples': int(self.total_samples),
+            'segment_num_samples': [int(num_samples) for num_samples in self.segment_num_samples],
+            'max_spikes_per_unit': self.max_spikes_per_unit,
+            'seed': self.seed,
+            'full_correlograms': self.full_correlograms,
+        }
+
+        # Write to a temporary file first, so that a crash never leaves a half-written bundle
+        bundle_path = Path(bundle_path)
+        temporary_path = bundle_path.with_suffix(".tmp")
+        with open(temporary_path, 'wb') as bundle_file:
+            np.savez_compressed(bundle_file, _metadata=np.array(json.dumps(metadata)), **bundle)
+        temporary_path.replace(bundle_path)
+
+    @classmethod
+    def from_bundle(cls, bundle_path):
+        """Load the data saved by `save_bundle`. The data can't be used to compute anything new."""
+
+        with np.load(bundle_path, allow_pickle=False) as bundle:
+            metadata = json.loads(str(bundle['_metadata']))
+            assert metadata['version'] == BUNDLE_VERSION, \
+                "This curation bundle was made by a different version of fast_curate. Please make it again with `batch.py`."
+            arrays = {name: bundle[name] for name in bundle.files if name != '_metadata'}
+
+        data = cls.__new__(cls)
+        data.merged_units = []
+        data.neighbour_correlograms = None
+        data.sorting_analyzer = None
+        data.cache = None
+        data.profiler = Profiler()
+        data.lazy = False
+        data.analyzer_folder = metadata['analyzer_folder']
+        data.have_extension = metadata['have_extension']
+        data.sampling_frequency = metadata['sampling_frequency']
+        data.total_samples = metadata['total_samples']
+        data.segment_num_samples = metadata['segment_num_samples']
+        data.max_spikes_per_unit = metadata['max_spikes_per_unit']
+        data.seed = metadata['seed']
+        data.full_correlograms = metadata['full_correlograms']
+
+        for name in BUNDLE_ARRAYS + ['unit_depths', 'template_similarity']:
+            setattr(data, name, arrays.get(name))
+        data.metrics = pd.DataFrame(
+            arrays['metrics_values'], index=arrays['metrics_index'], columns=arrays['metrics_columns'])
+
+        data.unit_xmin = min(data.channel_locations[:, 0])
+        data.unit_xmax = max(data.channel_locations[:, 0])
+        data.unit_ymin = min(data.channel_locations[:, 1])
+        data.unit_ymax = max(data.channel_locations[:, 1])
+
+        return data
+
+    def unit_slice(self, unit_index):
+
+        return slice(self.unit_spike_offsets[unit_index], self.unit_spike_offsets[unit_index + 1])
+
+    def wrangle_all_units(self, random_spike_indices, random_spikes, unit_order, window_bin_ms, executor):
+
+        have_extension = self.have_extension
+        max_spikes_per_unit = self.max_spikes_per_unit
+
+        if have_extension['spike_amplitudes']:
+            amplitudes_future = executor.submit(
+                self.get_part, "spike_amplitudes", ['spike_amplitudes'], lambda: self.compute_random_amplitudes(random_spike_indices),
+                max_spikes_per_unit=max_spikes_per_unit)
+        if have_extension['spike_locations']:
+            locations_future = executor.submit(
+                self.get_part, "spike_locations", ['spike_locations'], lambda: self.compute_random_locations(random_spike_indices),
+                max_spikes_per_unit=max_spikes_per_unit)
+
+        # numba's parallel kernels must be launched from the main thread: launching them from
+        # a worker thread can stop the process from exiting. The correlograms are computed
+        # here while the other parts are read in the background.
+        correlograms_part = self.get_part(
+            "correlograms", ['correlograms'], lambda: self.compute_correlograms(random_spikes, window_bin_ms),
+            max_spikes_per_unit=max_spikes_per_unit, window_bin_ms=window_bin_ms, full_correlograms=self.full_correlograms)
+        self.wide_correlograms = correlograms_part['wide_correlograms']
+        self.wide_bins = correlograms_part['wide_bins']
+        self.correlograms = correlograms_part['correlograms']
+        self.correlogram_bins = correlograms_part['correlogram_bins']
+
+        self.amps = None
+        self.locs_x = None
+        self.locs_y = None
+
+        if have_extension['spike_amplitudes']:
+            random_amps = amplitudes_future.result()['random_amps']
+            self.amps = random_amps[unit_order].astype(np.float32)
+
+        if have_extension['spike_locations']:
+            random_locs = locations_future.result()
+            self.locs_x = np.nan_to_num(random_locs['random_locs_x'][unit_order].astype(np.float32))
+            self.locs_y = np.nan_to_num(random_locs['random_locs_y'][unit_order].astype(np.float32))
+
+    def setup_lazy_units(self, window_bin_ms, num_prefetch, num_keep):
+        """
+        Get handles on the extension data, so that each unit's data can be computed
+        quickly when it is first needed.
+        """
+
+        self.window_bin_ms = window_bin_ms
+
+        self.amplitudes_data = None
+        if self.have_extension['spike_amplitudes']:
+            self.amplitudes_data = open_extension_array(self.sorting_analyzer, "spike_amplitudes", "amplitudes")
+
+        self.locations_data = None
+        if self.have_extension['spike_locations']:
+            self.locations_data = open_extension_array(self.sorting_analyzer, "spike_locations", "spike_locations")
+
+        if self.have_extension["correlograms"]:
+            self.all_correlograms, self.correlogram_bins = self.sorting_analyzer.get_extension(
+                "correlograms").get_data()
+
+        # keep the current unit, the upcoming prefetched units and a few previous units for undo
+        self.unit_data_cache = UnitDataPrefetcher(
+            self.timed_compute_unit_data, max_cached_units=num_prefetch + num_keep + 1)
+        self.num_prefetch = num_prefetch
+
+    ###############   Compute each (cacheable) part ###############
+
+    def compute_random_spikes(self):
+
+        from spikeinterface.core import random_spikes_selection
+
+        random_spike_indices = random_spikes_selection(
+            self.sorting_analyzer.sorting, max_spikes_per_unit=self.max_spikes_per_unit, seed=self.seed)
+        spike_vector = self.sorting_analyzer.sorting.to_spike_vector()
+        random_spikes = spike_vector[random_spike_indices]
+
+        return {'random_spike_indices': random_spike_indices, 'random_spikes': random_spikes}
+
+    def compute_random_amplitudes(self, random_spike_indices):
+
+        amps = open_extension_array(self.sorting_analyzer, "spike_amplitudes", "amplitudes")
+        return {'random_amps': read_spikes(amps, random_spike_indices)}
+
+    def compute_random_locations(self, random_spike_indices):
+
+        locs = open_extension_array(self.sorting_analyzer, "spike_locations", "spike_locations")
+        random_locs = read_spikes(locs, random_spike_indices)
+        return {'random_locs_x': random_locs['x'], 'random_locs_y': random_locs['y']}
+
+    def compute_templates(self):
+
+        from spikeinterface.core import get_template_extremum_channel
+
+        max_channels = self.sorting_analyzer.channel_ids_to_indices(
+            list(get_template_extremum_channel(self.sorting_analyzer).values())
+        )
+        templates_data = self.sorting_analyzer.get_extension("templates").get_data()
+
+        unit_indices = np.arange(len(self.unit_ids))
+        templates = templates_data[unit_indices, :, max_channels]
+
+        # (unit, sample, channel) -> (unit, channel, sample), then keep only the sparse channels
+        all_templates = np.ascontiguousarray(templates_data.transpose(0, 2, 1)[self.sparsity_mask])
+        template_channel_offsets = np.zeros(len(self.unit_ids) + 1, dtype=np.int64)
+        template_channel_offsets[1:] = np.cumsum(self.sparsity_mask.sum(axis=1))
+
+        return {'templates': templates, 'all_templates': all_templates, 'template_channel_offsets': template_channel_offsets}
+
+    def compute_firing_rates(self, segment_num_samples, bin_size):
+
+        fs = self.sorting_analyzer.sampling_frequency
+        firing_rates, bin_edges = compute_firing_rates(
+            open_spike_vector(self.sorting_analyzer), len(self.unit_ids), segment_num_samples, bin_size)
+
+        return {'firing_rates': (firing_rates * fs).astype(np.float32), 'firing_rate_bins': bin_edges / fs}
+
+    def compute_spike_densities(self, random_spike_indices, random_spikes, segment_num_samples):
+
+        spike_vector = open_spike_vector(self.sorting_analyzer)
+        num_units = len(self.unit_ids)
+
+        densities = {}
+        for name, extension_name, array_name, field in [('amp', 'spike_amplitudes', 'amplitudes', None),
+                                                        ('loc', 'spike_locations', 'spike_locations', 'y')]:
+            if self.have_extension[extension_name] is False:
+                continue
+            values = open_extension_array(self.sorting_analyzer, extension_name, array_name)
+
+            # each unit's images span most of the values of its random spikes
+            random_values = read_spikes(values, random_spike_indices)
+            if field is not None:
+                random_values = random_values[field]
+            value_ranges = get_value_ranges(random_values, random_spikes['unit_index'], num_units)
+
+            unit_densities, bin_edges = compute_spike_densities(
+                spike_vector, values, value_ranges, segment_num_samples, DENSITY_TIME_BINS, DENSITY_VALUE_BINS, field)
+            densities[f'{name}_densities'] = unit_densities.astype(np.uint32)
+            densities[f'{name}_density_ranges'] = value_ranges.astype(np.float32)
+            densities['density_bins'] = bin_edges / self.sampling_frequency
+
+        return densities
+
+    def compute_metrics(self):
 
         quality_metrics = pd.DataFrame()
-        if have_extension['quality_metrics']:
-            quality_metrics = sorting_analyzer.get_extension(
+        if self.have_extension['quality_metrics']:
+            quality_metrics = self.sorting_analyzer.get_extension(
                 "quality_metrics").get_data().astype('float')
-        
+
         template_metrics = pd.DataFrame()
-        if have_extension['template_metrics']:
-            template_metrics = sorting_analyzer.get_extension(
+        if self.have_extension['template_metrics']:
+            template_metrics = self.sorting_analyzer.get_extension(
                 "template_metrics").get_data().astype('float')
 
-        self.metrics = pd.concat([quality_metrics, template_metrics], axis=1)
+        metrics = pd.concat([quality_metrics, template_metrics], axis=1)
 
-        if have_extension["correlograms"]:
-            all_correlograms, bins = sorting_analyzer.get_extension(
-                "correlograms").get_data()
+        return {
+            'values': metrics.to_numpy(dtype='float'),
+            'index': np.array(metrics.index.tolist()),
+            'columns': np.array(metrics.columns.tolist(), dtype='str'),
+        }
+
+    def compute_correlograms(self, random_spikes, window_bin_ms):
+
+        with self.profiler.time("wrangle/correlograms/autocorrelograms"):
+            if self.full_correlograms:
+                autocorrelograms = compute_streamed_autocorrelograms(
+                    open_spike_vector(self.sorting_analyzer), num_units=len(self.sorting_analyzer.unit_ids), fs=self.sorting_analyzer.sampling_frequency, window_bin_ms=window_bin_ms)
+            else:
+                autocorrelograms = compute_all_autocorrelograms(
+                    self.get_correlogram_spikes(get_spike_times(random_spikes, self.segment_num_samples)), random_spikes['unit_index'], num_units=len(self.sorting_analyzer.unit_ids), fs=self.sorting_analyzer.sampling_frequency, window_bin_ms=window_bin_ms)
+        wide_correlograms, wide_bins = autocorrelograms[0]
+
+        if self.have_extension["correlograms"]:
+            with self.profiler.time("wrangle/correlograms/extension"):
+                all_correlograms, correlogram_bins = self.sorting_analyzer.get_extension(
+                    "correlograms").get_data()
+                unit_indices = np.arange(len(self.sorting_analyzer.unit_ids))
+                correlograms = all_correlograms[unit_indices, unit_indices]
         else:
+            correlograms, correlogram_bins = autocorrelograms[1]
+
+        return {
+            'correlograms': correlograms,
+            'correlogram_bins': correlogram_bins,
+            'wide_correlograms': wide_correlograms,
+            'wide_bins': wide_bins,
+        }
+
+    def compute_unit_data(self, unit_index):
+        """Compute all the data needed to plot one unit. Used in lazy mode."""
+
+        unit_data = {}
+
+        unit_spike_indices = self.unit_spike_indices[self.unit_slice(unit_index)]
+
+        unit_data['spikes'] = self.spikes[self.unit_slice(unit_index)]
+
+        unit_data['amps'] = None
+        if self.amplitudes_data is not None:
+            unit_data['amps'] = read_spikes(self.amplitudes_data, unit_spike_indices).astype(np.float32)
+
+        unit_data['locs_x'] = None
+        unit_data['locs_y'] = None
+        if self.locations_data is not None:
+            unit_locs = read_spikes(self.locations_data, unit_spike_indices)
+            unit_data['locs_x'] = np.nan_to_num(unit_locs['x'].astype(np.float32))
+            unit_data['locs_y'] = np.nan_to_num(unit_locs['y'].astype(np.float32))
+
+        self.add_unit_templates(unit_data, unit_index)
+
+        if self.full_correlograms:
+            autocorrelograms = self.compute_full_unit_autocorrelograms(unit_index)
+        else:
+            autocorrelograms = compute_all_autocorrelograms(
+                self.get_correlogram_spikes(unit_data['spikes']), np.zeros(len(unit_data['spikes']), dtype=np.int64), num_units=1, fs=self.sorting_analyzer.sampling_frequency, window_bin_ms=self.window_bin_ms, parallel=False)
+        unit_data['wide_correlograms'], unit_data['wide_bins'] = autocorrelograms[0][0][0], autocorrelograms[0][1]
+
+        if self.have_extension["correlograms"]:
+            unit_data['correlograms'] = self.all_correlograms[unit_index, unit_index]
+            unit_data['correlogram_bins'] = self.correlogram_bins
+        else:
+            unit_data['correlograms'], unit_data['correlogram_bins'] = autocorrelograms[1][0][0], autocorrelograms[1][1]
+
+        self.add_unit_summary(unit_data, unit_index)
+
+        return unit_data
+
+    def get_correlogram_spikes(self, spike_times):
+        """
+        `spike_times` with a second between segments, which is wider than any correlogram
+        window, so that the correlograms never pair spikes in different segments.
+        """
+
+        return separate_segments(spike_times, self.segment_num_samples, gap=int(np.ceil(self.sampling_frequency)))
+
+    def compute_full_unit_autocorrelograms(self, unit_index):
+        """The autocorrelograms of all of one unit's spikes, summed over the segments."""
+
+        sorting = self.sorting_analyzer.sorting
+        autocorrelograms = None
+        for segment_index in range(sorting.get_num_segments()):
+            spike_train = sorting.get_unit_spike_train(self.unit_ids[unit_index], segment_index=segment_index)
+            segment_autocorrelograms = compute_all_autocorrelograms(
+                spike_train, np.zeros(len(spike_train), dtype=np.int64), num_units=1, fs=self.sorting_analyzer.sampling_frequency, window_bin_ms=self.window_bin_ms, parallel=False)
+            if autocorrelograms is None:
+                autocorrelograms = segment_autocorrelograms
+            else:
+                autocorrelograms = [(correlograms + segment_correlograms, bins) for (correlograms, bins), (segment_correlograms, _) in zip(autocorrelograms, segment_autocorrelograms)]
+
+        return autocorrelograms
+
+    def timed_compute_unit_data(self, unit_index):
+
+        with self.profiler.time("unit_data/compute"):
+            return self.compute_unit_data(unit_index)
+
+    def prefetch(self, unit_indices):
+        """In lazy mode, start computing the data for the upcoming units in the background."""
+
+        if self.lazy:
+            self.unit_data_cache.prefetch(unit_indices[:self.num_prefetch])
 
-            all_correlograms = {}
-            for unit_id in sorting_analyzer.unit_ids:
-                one_corr, bins = compute_autocorrelograms(self.spikes[unit_id], window_ms=50, bin_ms=2, fs=sorting_analyzer.sampling_frequency)
-                all_correlograms[unit_id] = {}
-                all_correlograms[unit_id][unit_id] = one_corr
-        self.correlograms = all_correlograms
-        self.correlogram_bins = bins
-
-        wide_correlograms = []
-        for unit_id in sorting_analyzer.unit_ids:
-            one_wide, bins = compute_autocorrelograms(self.spikes[unit_id], window_ms=500, bin_ms=5, fs=sorting_analyzer.sampling_frequency)
-            wide_correlograms.append(one_wide)
-        self.wide_correlograms = wide_correlograms
-        self.wide_bins = bins
-    
     def get_unit_data(self, unit_index):
 
+        if self.lazy:
+            return self.unit_data_cache.get(unit_index)
+
         unit_data = {}
 
-        unit_data['amps'] = self.amps.get(unit_index)
-        unit_data['locs_x'] = np.nan_to_num(self.locs_x.get(unit_index))
-        unit_data['locs_y'] = np.nan_to_num(self.locs_y.get(unit_index))
+        # These are all views into the arrays grouped by unit, so nothing is copied
+        unit_slice = self.unit_slice(unit_index)
+        for key in ['amps', 'locs_x', 'locs_y']:
+            unit_data[key] = None
+            if getattr(self, key) is not None:
+                unit_data[key] = getattr(self, key)[unit_slice]
 
-        unit_data['spikes'] = self.spikes[unit_index]
+        unit_data['spikes'] = self.spikes[unit_slice]
 
-        unit_data['template'] = self.templates.get(unit_index)
+        self.add_unit_templates(unit_data, unit_index)
 
-        unit_data['correlograms'] = self.correlograms[unit_index][unit_index]
+        unit_data['correlograms'] = self.correlograms[unit_index]
         unit_data['correlogram_bins'] = self.correlogram_bins
 
         unit_data['wide_correlograms'] = self.wide_correlograms[unit_index]
         unit_data['wide_bins'] = self.wide_bins
 
+        self.add_unit_summary(unit_data, unit_index)
+
+        return unit_data
+
+    def add_unit_templates(self, unit_data, unit_index):
+
+        unit_data['template'] = None
+        unit_data['all_templates'] = None
+        if self.templates is not None:
+            unit_data['template'] = self.templates[unit_index]
+            unit_data['all_templates'] = self.all_templates[
+                self.template_channel_offsets[unit_index]:self.template_channel_offsets[unit_index + 1]]
+
+    def add_unit_summary(self, unit_data, unit_index):
+
         try:
             unit_data['unit_location'] = self.unit_locations[unit_index]
         except:
             unit_data['unit_location'] = None
 
-        unit_data['binned_spikes'], _ = np.histogram(unit_data['spikes'], bins=20)
-        unit_data['all_templates'] = self.all_templates.get(unit_index)
+        unit_data['firing_rates'] = self.firing_rates[unit_index]
+        unit_data['firing_rate_bins'] = self.firing_rate_bins
+
+        for name in ['amp', 'loc']:
+            unit_data[f'{name}_density'] = None
+            unit_data[f'{name}_density_range'] = None
+            if getattr(self, f'{name}_densities') is not None:
+                unit_data[f'{name}_density'] = getattr(self, f'{name}_densities')[unit_index]
+                unit_data[f'{name}_density_range'] = getattr(self, f'{name}_density_ranges')[unit_index]
+        unit_data['density_bins'] = self.density_bins
 
         unit_data['channel_locations'] = self.channel_locations
 
-        return unit_data
 
+class PairCorrelogramCache:
+    """
+    Computes the cross-correlograms of pairs of units in a background thread, only for the
+    pairs which are asked for. Every pair is kept once it's computed, so going back to a
+    unit doesn't compute its pairs again. The two directions of a pair are computed
+    separately: the bins are [-w, w), so flipping one direction would move every lag
+    which is on a bin edge (e.g. zero lag) into the wrong bin.
+    """
+
+    def __init__(self, compute_pair_correlograms):
+
+        self.compute_pair_correlograms = compute_pair_correlograms
+
+        # (unit index, neighbour index): the neighbour's spikes relative to the unit's
+        self.pair_correlograms = {}
+        self.bins = None
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def get(self, unit_index, neighbours):
+
+        return self.executor.submit(self.get_unit_correlograms, unit_index, neighbours)
+
+    def get_unit_correlograms(self, unit_index, neighbours):
+
+        pairs = [(unit_index, neighbour) for neighbour in neighbours if neighbour >= 0]
+        with self.lock:
+            new_pairs = [pair for pair in pairs if pair not in self.pair_correlograms]
+
+        if len(new_pairs) > 0 or self.bins is None:
+            correlograms, bins = self.compute_pair_correlograms(new_pairs)
+            with self.lock:
+                self.pair_correlograms.update(zip(new_pairs, correlograms))
+                self.bins = bins
+
+        # each neighbour's spikes relative to the unit's
+        unit_correlograms = []
+        with self.lock:
+            for neighbour in neighbours:
+                if neighbour < 0:
+                    unit_correlograms.append(None)
+                else:
+                    unit_correlograms.append(self.pair_correlograms[(unit_index, neighbour)])
+
+        return neighbours, unit_correlograms, self.bins
+
+
+def load_extensions(sorting_analyzer, extension_names, max_workers=None):
+    """
+    Load the extensions of `sorting_analyzer` in parallel threads: each one is independent
+    file reading and decompression. Returns whether each extension exists, and how long
+    each took to load.
+    """
+
+    def load_extension(extension_name):
+
+        start_time = time.perf_counter()
+        try:
+            # The per-spike extensions are large, so are read directly (and only in part) from
+            # disk by `DataForGUI`, rather than loaded into memory here.
+            if extension_name in ['spike_amplitudes', 'spike_locations']:
+                loaded = sorting_analyzer.has_extension(extension_name)
+            else:
+                loaded = sorting_analyzer.load_extension(extension_name) is not None
+        except Exception:
+            loaded = False
+        return loaded, time.perf_counter() - start_time
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = dict(zip(extension_names, executor.map(load_extension, extension_names)))
+
+    have_extension = {extension_name: loaded for extension_name, (loaded, _) in results.items()}
+    load_times = {extension_name: load_time for extension_name, (_, load_time) in results.items()}
+
+    return have_extension, load_times
+
+
+def open_spike_vector(sorting_analyzer):
+    """
+    Open the spike vector of the analyzer's sorting without reading it into memory, as a
+    memmap of its `spikes.npy` for a binary folder. Other analyzers load it with
+    `sorting.to_spike_vector()`.
+    """
+
+    if sorting_analyzer.format == "binary_folder":
+        spikes_path = Path(sorting_analyzer.folder) / "sorting" / "spikes.npy"
+        if spikes_path.is_file():
+            return np.load(spikes_path, mmap_mode='r')
+    return sorting_analyzer.sorting.to_spike_vector()
+
+
+def open_extension_array(sorting_analyzer, extension_name, array_name):
+    """
+    Open one of an extension's per-spike arrays without reading it into memory: as a
+    memmap for a binary folder, or as a lazy zarr array. Analyzers in memory just
+    return the extension's data.
+    """
+
+    if sorting_analyzer.format == "binary_folder":
+        array_path = Path(sorting_analyzer.folder) / "extensions" / extension_name / f"{array_name}.npy"
+        return np.load(array_path, mmap_mode='r')
+    elif sorting_analyzer.format == "zarr":
+        import zarr
+        zarr_root = zarr.open(str(sorting_analyzer.folder), mode='r')
+        return zarr_root["extensions"][extension_name][array_name]
+    else:
+        return sorting_analyzer.get_extension(extension_name).get_data()
+
+
+def read_spikes(array, spike_indices, chunk_size=100_000):
+    """
+    Gather `array[spike_indices]` from a memmap or zarr array. The indices are read in
+    sorted chunks so that only the pages (or zarr chunks) holding the selected spikes are
+    ever read, and the peak memory scales with the number of selected spikes.
+    """
+
+    spike_indices = np.asarray(spike_indices)
+    sort_order = None
+    if np.any(np.diff(spike_indices) < 0):
+        sort_order = np.argsort(spike_indices, kind='stable')
+        spike_indices = spike_indices[sort_order]
+
+    spikes = np.empty(spike_indices.size, dtype=array.dtype)
+    for start in range(0, spike_indices.size, chunk_size):
+        chunk_indices = spike_indices[start:start + chunk_size]
+        if isinstance(array, np.ndarray):
+            spikes[start:start + chunk_size] = array[chunk_indices]
+        else:
+            spikes[start:start + chunk_size] = array.get_coordinate_selection(chunk_indices)
+
+    if sort_order is not None:
+        unsorted_spikes = np.empty_like(spikes)
+        unsorted_spikes[sort_order] = spikes
+        spikes = unsorted_spikes
+
+    return spikes
+
+
+class UnitDataPrefetcher:
+    """
+    Computes each unit's data on first access, and prefetches upcoming units in a background
+    thread. Only the most recently used `max_cached_units` units are kept in memory.
+    """
+
+    def __init__(self, compute_unit_data, max_cached_units):
+
+        self.compute_unit_data = compute_unit_data
+        self.max_cached_units = max_cached_units
+
+        self.unit_futures = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def get(self, unit_index):
+
+        with self.lock:
+            future = self.unit_futures.get(unit_index)
+            if future is not None:
+                self.unit_futures.move_to_end(unit_index)
+
+        # If the unit hasn't been prefetched, compute it right now rather than
+        # waiting behind the prefetch queue.
+        if future is None:
+            future = Future()
+            future.set_result(self.compute_unit_data(unit_index))
+            with self.lock:
+                self.unit_futures[unit_index] = future
+                self.evict()
+
+        return future.result()
+
+    def prefetch(self, unit_indices):
+
+        with self.lock:
+            for unit_index in unit_indices:
+                if unit_index not in self.unit_futures:
+                    self.unit_futures[unit_index] = self.executor.submit(self.compute_unit_data, unit_index)
+            self.evict()
+
+    def evict(self):
+
+        while len(self.unit_futures) > self.max_cached_units:
+            _, future = self.unit_futures.popitem(last=False)
+            future.cancel()